@@ -0,0 +1,227 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import traceback
+
+DIRECTORIO_BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+DIRECTORIO_SCRIPTS = os.path.join(DIRECTORIO_BENCHMARKS, '..', 'scripts')
+sys.path.insert(0, DIRECTORIO_SCRIPTS)
+
+import ciudades_sinteticas as cs
+import carga_datos_yDevolver_json as carga_datos
+import nodos_rutas_y_pesos as nrp
+import bucles_zonas_verdes
+import TSP
+import main
+
+PERFIL_PERRO = {'tamaño': 'mediano', 'edad': 5, 'raza': 'Beagle'}
+DURACION_PASEO = 300
+UMBRAL_REGRESION = 1.25  # Una etapa es regresión si tarda un 25 % más que en la referencia
+MODULOS_IMPORTACION = ('main', 'nodos_rutas_y_pesos', 'servicio_rutas', 'planificacion_lotes', 'grafo_compilado', 'TSP')
+
+def medir(funcion, repeticiones, memoria=True):
+    # Tiempo (mínimo y mediana de varias repeticiones) y pico de memoria de una etapa
+    tiempos = []
+    resultado = None
+    for _ in range(repeticiones):
+        gc.collect()
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    medida = {'tiempo_min': min(tiempos), 'tiempo_mediana': statistics.median(tiempos), 'repeticiones': repeticiones}
+    if memoria:
+        # Pasada aparte para que tracemalloc no distorsione los tiempos
+        gc.collect()
+        tracemalloc.start()
+        funcion()
+        medida['memoria_pico'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return medida, resultado
+
+def medir_etapa(resultados, nombre, funcion, repeticiones, memoria):
+    try:
+        resultados[nombre], resultado = medir(funcion, repeticiones, memoria)
+    except Exception as e:
+        resultados[nombre] = {'error': f"{type(e).__name__}: {e}", 'traza': traceback.format_exc(limit=3)}
+        return None
+    print(f"  {nombre}: {resultados[nombre]['tiempo_min']:.4f} s", file=sys.stderr)
+    return resultado
+
+def nodo_central(G):
+    x = sum(data['x'] for _, data in G.nodes(data=True)) / G.number_of_nodes()
+    y = sum(data['y'] for _, data in G.nodes(data=True)) / G.number_of_nodes()
+    return min(G.nodes, key=lambda n: (G.nodes[n]['x'] - x) ** 2 + (G.nodes[n]['y'] - y) ** 2)
+
+def ejecutar_ciudad(directorio, repeticiones, memoria):
+    nodos_gdf, aristas_gdf = carga_datos.cargar_datos_geojson(os.path.join(directorio, 'nodos_burgos.geojson'),
+                                                              os.path.join(directorio, 'aristas_burgos.geojson'))
+    zonas_verdes_gdf = carga_datos.zonas_verdes_gdf(os.path.join(directorio, 'parques.geojson'))
+    resultados = {}
+
+    G = medir_etapa(resultados, 'crear_grafo_desde_geojson',
+                    lambda: nrp.crear_grafo_desde_geojson(nodos_gdf, aristas_gdf), repeticiones, memoria)
+    if G is None:
+        return resultados
+
+    def ponderar():
+        H = G.copy()
+        nrp.aplicar_peso_zonas_verdes(H, zonas_verdes_gdf, distancia_umbral=10, factor_reduccion=0.5,
+                                      factor_reduccion_dog_park=0.7)
+        return H
+    G = medir_etapa(resultados, 'aplicar_peso_zonas_verdes', ponderar, repeticiones, memoria) or G
+
+    # Actualizaciones incrementales de la capa de pesos: cambio de factor y alta de un parque
+    capa = nrp.CapaZonasVerdes(G.copy(), zonas_verdes_gdf, distancia_umbral=10, factor_reduccion=0.5,
+                               factor_reduccion_dog_park=0.7, recalcular=False)
+    factores = iter([0.6, 0.5] * repeticiones * 2)
+    aristas = medir_etapa(resultados, 'cambiar_factores', lambda: capa.cambiar_factores(factor_reduccion=next(factores)),
+                          repeticiones, memoria)
+    if aristas is not None:
+        resultados['cambiar_factores']['aristas'] = aristas
+    parque = zonas_verdes_gdf.geometry.iloc[0]
+    aristas = medir_etapa(resultados, 'añadir_zona_verde', lambda: capa.añadir_zona_verde(parque, leisure='park'),
+                          repeticiones, memoria)
+    if aristas is not None:
+        resultados['añadir_zona_verde']['aristas'] = aristas
+
+    nodo_inicio = nodo_central(G)
+    distancia = nrp.estimar_distancia(DURACION_PASEO, PERFIL_PERRO)
+    rutas = medir_etapa(resultados, 'encontrar_rutas_circulares',
+                        lambda: nrp.encontrar_rutas_circulares(G, nodo_inicio, distancia), repeticiones, memoria)
+    resultados['encontrar_rutas_circulares']['rutas'] = len(rutas or [])
+
+    bucles = medir_etapa(resultados, 'generar_bucles_zonas_verdes',
+                         lambda: bucles_zonas_verdes.generar_bucles(G, nodo_inicio, distancia, zonas_verdes_gdf),
+                         repeticiones, memoria)
+    resultados['generar_bucles_zonas_verdes']['rutas'] = len(bucles or [])
+
+    ruta = medir_etapa(resultados, 'seleccionar_ruta',
+                       lambda: nrp.seleccionar_ruta(rutas or [], G, zonas_verdes_gdf, PERFIL_PERRO, nodo_inicio),
+                       repeticiones, memoria)
+
+    nodos_tsp = [nodo_inicio] + TSP.identificar_nodos_cercanos(G, zonas_verdes_gdf, distancia_umbral=30)[:15]
+    medir_etapa(resultados, 'resolver_tsp',
+                lambda: TSP.resolver_tsp(G, nodos_tsp, tiempo_limite=None, busqueda_local_guiada=False),
+                repeticiones, memoria)
+
+    if ruta is not None:
+        medir_etapa(resultados, 'visualizar_rutas',
+                    lambda: nrp.visualizar_rutas(G, [ruta], G.nodes[nodo_inicio]['y'], G.nodes[nodo_inicio]['x']),
+                    1, memoria)
+
+    # Extremo a extremo a través de main.main; la primera llamada incluye la compilación del grafo
+    json_input = json.dumps({'latitud': G.nodes[nodo_inicio]['y'], 'longitud': G.nodes[nodo_inicio]['x'],
+                             'duracion': DURACION_PASEO, **PERFIL_PERRO})
+    medir_etapa(resultados, 'main_primera_llamada', lambda: main.main(json_input), 1, False)
+    medir_etapa(resultados, 'main', lambda: main.main(json_input), repeticiones, memoria)
+    return resultados
+
+def medir_importacion(modulo, repeticiones, num_dependencias=8):
+    # Tiempo de importación de un módulo en un intérprete nuevo (python -X importtime), con las
+    # dependencias de primer nivel que más pesan
+    mejor = None
+    for _ in range(repeticiones):
+        proceso = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {modulo}"], capture_output=True,
+                                 text=True, cwd=DIRECTORIO_SCRIPTS, env={**os.environ, 'PYTHONPATH': DIRECTORIO_SCRIPTS})
+        if proceso.returncode != 0:
+            return {'error': proceso.stderr.strip().splitlines()[-1]}
+        # Líneas "import time: propio | acumulado | nombre", en microsegundos
+        acumulados = {}
+        for linea in proceso.stderr.splitlines():
+            if linea.startswith('import time:') and 'cumulative' not in linea:
+                _, acumulado, nombre = linea[len('import time:'):].split('|')
+                acumulados[nombre.strip()] = int(acumulado) / 1e6
+        if mejor is None or acumulados[modulo] < mejor[modulo]:
+            mejor = acumulados
+    dependencias = sorted(((nombre, tiempo) for nombre, tiempo in mejor.items() if '.' not in nombre and nombre != modulo),
+                          key=lambda par: par[1], reverse=True)[:num_dependencias]
+    return {'tiempo_min': mejor[modulo], 'repeticiones': repeticiones, 'dependencias': dict(dependencias)}
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=DIRECTORIO_BENCHMARKS, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def comparar(resultados, referencia):
+    # Lista de etapas que empeoran respecto a un JSON de resultados anterior
+    regresiones = []
+    for modulo, medida in resultados.get('importacion', {}).items():
+        anterior = referencia.get('importacion', {}).get(modulo, {})
+        if 'tiempo_min' in medida and anterior.get('tiempo_min'):
+            cociente = medida['tiempo_min'] / anterior['tiempo_min']
+            if cociente > UMBRAL_REGRESION:
+                regresiones.append({'ciudad': None, 'etapa': f"importar {modulo}", 'cociente': cociente})
+    for ciudad, etapas in resultados['ciudades'].items():
+        for etapa, medida in etapas.items():
+            anterior = referencia.get('ciudades', {}).get(ciudad, {}).get(etapa, {})
+            if 'tiempo_min' in medida and anterior.get('tiempo_min'):
+                cociente = medida['tiempo_min'] / anterior['tiempo_min']
+                if cociente > UMBRAL_REGRESION:
+                    regresiones.append({'ciudad': ciudad, 'etapa': etapa, 'cociente': cociente})
+    return regresiones
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de las etapas del cálculo de rutas con ciudades sintéticas")
+    parser.add_argument('--tamaños', type=int, nargs='+', default=[1000, 10000, 50000, 200000],
+                        help="Número aproximado de aristas de cada ciudad")
+    parser.add_argument('--tipos', nargs='+', default=['rejilla', 'planar'], choices=sorted(cs.GENERADORES))
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--sin-memoria', action='store_true', help="No medir el pico de memoria con tracemalloc")
+    parser.add_argument('--sin-importacion', action='store_true', help="No medir el tiempo de importación de los módulos")
+    parser.add_argument('--directorio-ciudades', default=os.path.join(DIRECTORIO_BENCHMARKS, 'ciudades'))
+    parser.add_argument('--salida', default=None)
+    parser.add_argument('--comparar', default=None, help="JSON de resultados de otro commit para detectar regresiones")
+    args = parser.parse_args()
+
+    commit = commit_actual()
+    resultados = {
+        'commit': commit,
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parametros': {'perfil_perro': PERFIL_PERRO, 'duracion': DURACION_PASEO, 'repeticiones': args.repeticiones},
+        'importacion': {},
+        'ciudades': {},
+    }
+    if not args.sin_importacion:
+        for modulo in MODULOS_IMPORTACION:
+            resultados['importacion'][modulo] = medir_importacion(modulo, max(args.repeticiones, 3))
+            medida = resultados['importacion'][modulo]
+            print(f"importar {modulo}: " + (f"{medida['tiempo_min']:.4f} s" if 'tiempo_min' in medida else medida['error']),
+                  file=sys.stderr)
+    directorio_inicial = os.getcwd()
+    for tipo in args.tipos:
+        for tamaño in args.tamaños:
+            nombre = f"{tipo}_{tamaño}"
+            directorio = os.path.abspath(os.path.join(args.directorio_ciudades, nombre))
+            # Las ciudades son deterministas (semilla fija): se generan una vez y se reutilizan entre commits
+            if not os.path.exists(os.path.join(directorio, 'parques.geojson')):
+                cs.guardar_ciudad(directorio, tipo, tamaño)
+            print(f"{nombre}", file=sys.stderr)
+            # main.main lee los archivos del directorio de trabajo
+            os.chdir(directorio)
+            try:
+                resultados['ciudades'][nombre] = ejecutar_ciudad(directorio, args.repeticiones, not args.sin_memoria)
+            finally:
+                os.chdir(directorio_inicial)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            resultados['regresiones'] = comparar(resultados, json.load(f))
+        for regresion in resultados['regresiones']:
+            print(f"REGRESIÓN {regresion['ciudad'] or ''} {regresion['etapa']}: x{regresion['cociente']:.2f}", file=sys.stderr)
+
+    salida = args.salida or os.path.join(DIRECTORIO_BENCHMARKS, 'resultados', f"{commit or 'sin_commit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(resultados, f, ensure_ascii=False, indent=2)
+    print(salida)
@@ -0,0 +1,73 @@
+import os
+import sys
+import numpy as np
+import geopandas as gpd
+import shapely
+from scipy.spatial import Delaunay
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import distancias as dist
+
+LATITUD_CENTRO, LONGITUD_CENTRO = 42.3439, -3.7007  # Burgos
+SEPARACION = 0.0009  # Grados entre cruces (~100 m)
+
+def gdf_calles(x, y, u, v):
+    # Nodos y aristas con el esquema que lee cargar_datos_geojson (osmid / u, v, length)
+    nodos_gdf = gpd.GeoDataFrame({'osmid': np.arange(len(x))}, geometry=shapely.points(x, y), crs="EPSG:4326")
+    lineas = shapely.linestrings(np.stack([np.column_stack([x[u], y[u]]), np.column_stack([x[v], y[v]])], axis=1))
+    aristas_gdf = gpd.GeoDataFrame({'u': u, 'v': v, 'length': dist.haversine(y[u], x[u], y[v], x[v])},
+                                   geometry=lineas, crs="EPSG:4326")
+    return nodos_gdf, aristas_gdf
+
+def generar_rejilla(num_aristas, semilla=0):
+    # Cuadrícula con algo de ruido en los cruces: una rejilla n x n tiene 2 n (n - 1) aristas
+    rng = np.random.default_rng(semilla)
+    n = max(2, int(round((1 + np.sqrt(1 + 2 * num_aristas)) / 2)))
+    filas, columnas = np.divmod(np.arange(n * n), n)
+    x = LONGITUD_CENTRO + (columnas - n / 2) * SEPARACION + rng.normal(0, SEPARACION / 10, n * n)
+    y = LATITUD_CENTRO + (filas - n / 2) * SEPARACION + rng.normal(0, SEPARACION / 10, n * n)
+    indices = np.arange(n * n).reshape(n, n)
+    u = np.concatenate([indices[:, :-1].ravel(), indices[:-1, :].ravel()])
+    v = np.concatenate([indices[:, 1:].ravel(), indices[1:, :].ravel()])
+    return gdf_calles(x, y, u, v)
+
+def generar_planar_aleatoria(num_aristas, semilla=0):
+    # Triangulación de Delaunay de puntos aleatorios (unas 3 aristas por nodo) aclarada hasta num_aristas
+    rng = np.random.default_rng(semilla)
+    num_nodos = max(4, num_aristas // 2)
+    lado = np.sqrt(num_nodos) * SEPARACION
+    x = LONGITUD_CENTRO + rng.uniform(-lado / 2, lado / 2, num_nodos)
+    y = LATITUD_CENTRO + rng.uniform(-lado / 2, lado / 2, num_nodos)
+    triangulos = Delaunay(np.column_stack([x, y])).simplices
+    pares = np.sort(np.concatenate([triangulos[:, [0, 1]], triangulos[:, [1, 2]], triangulos[:, [0, 2]]]), axis=1)
+    pares = np.unique(pares, axis=0)
+    # Quitar primero las aristas más largas, como las diagonales que no existirían en una ciudad
+    longitudes = np.hypot(x[pares[:, 0]] - x[pares[:, 1]], y[pares[:, 0]] - y[pares[:, 1]])
+    pares = pares[np.argsort(longitudes, kind='stable')][:num_aristas]
+    return gdf_calles(x, y, pares[:, 0], pares[:, 1])
+
+def generar_parques(nodos_gdf, num_parques, semilla=0):
+    # Polígonos alrededor de nodos al azar; uno de cada cinco es un dog park
+    rng = np.random.default_rng(semilla)
+    centros = nodos_gdf.geometry.values[rng.choice(len(nodos_gdf), size=num_parques, replace=len(nodos_gdf) < num_parques)]
+    radios = rng.uniform(SEPARACION / 3, 2 * SEPARACION, num_parques)
+    geometrias = shapely.buffer(centros, radios, quad_segs=4)
+    es_dog_park = np.arange(num_parques) % 5 == 0
+    return gpd.GeoDataFrame({
+        'name': [None] * num_parques,
+        'leisure': np.where(es_dog_park, 'dog_park', 'park'),
+        'tipo_jardin': np.where(es_dog_park, 'dog_park', 'park'),
+        'id': np.arange(1, num_parques + 1),
+    }, geometry=geometrias, crs="EPSG:4326")
+
+GENERADORES = {'rejilla': generar_rejilla, 'planar': generar_planar_aleatoria}
+
+def guardar_ciudad(directorio, tipo, num_aristas, semilla=0):
+    # Guarda la ciudad con los nombres de archivo que espera main.main
+    nodos_gdf, aristas_gdf = GENERADORES[tipo](num_aristas, semilla)
+    parques_gdf = generar_parques(nodos_gdf, max(5, num_aristas // 100), semilla)
+    os.makedirs(directorio, exist_ok=True)
+    nodos_gdf.to_file(os.path.join(directorio, 'nodos_burgos.geojson'), driver='GeoJSON')
+    aristas_gdf.to_file(os.path.join(directorio, 'aristas_burgos.geojson'), driver='GeoJSON')
+    parques_gdf.to_file(os.path.join(directorio, 'parques.geojson'), driver='GeoJSON')
+    return nodos_gdf, aristas_gdf, parques_gdf
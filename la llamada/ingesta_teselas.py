@@ -0,0 +1,170 @@
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import geopandas as gpd
+import networkx as nx
+import pandas as pd
+from shapely.geometry import LineString, Point
+import llamada_api_con_radios as api_osm
+
+TAMAÑO_TESELA = 0.01  # Grados por lado de cada tesela (~1.1 km de latitud)
+RADIO_TIERRA = 6371008.8
+# Esquema de las capas de calles (el de nodos_burgos / aristas_burgos)
+COLUMNAS_NODOS = {'osmid': 'int64'}
+COLUMNAS_ARISTAS = {'u': 'int64', 'v': 'int64', 'osmid_way': 'int64', 'length': 'float64'}
+
+def teselas_para_radio(lat, lon, radio_km):
+    # Teselas fijas (índices enteros de una rejilla global) que cubren el círculo pedido
+    radio_lat = radio_km / 111.32
+    radio_lon = radio_lat / max(math.cos(math.radians(lat)), 1e-6)
+    x_min, x_max = math.floor((lon - radio_lon) / TAMAÑO_TESELA), math.floor((lon + radio_lon) / TAMAÑO_TESELA)
+    y_min, y_max = math.floor((lat - radio_lat) / TAMAÑO_TESELA), math.floor((lat + radio_lat) / TAMAÑO_TESELA)
+    return [(tx, ty) for tx in range(x_min, x_max + 1) for ty in range(y_min, y_max + 1)]
+
+def caja_tesela(tx, ty):
+    # Caja en el orden de Overpass: sur, oeste, norte, este
+    return f"{ty * TAMAÑO_TESELA:.6f},{tx * TAMAÑO_TESELA:.6f},{(ty + 1) * TAMAÑO_TESELA:.6f},{(tx + 1) * TAMAÑO_TESELA:.6f}"
+
+def consulta_calles(caja):
+    return f"""
+    [out:json];
+    way["highway"]({caja});
+    (._;>;);
+    out body;
+    """
+
+def obtener_respuesta_cruda(tipo, tx, ty, directorio_cache, directorio_fixtures=None):
+    # Respuesta JSON de Overpass de una tesela: primero la caché, después los fixtures locales o la API
+    nombre = f"{tipo}_{tx}_{ty}.json"
+    ruta_cache = os.path.join(directorio_cache, 'crudo', nombre)
+    if os.path.exists(ruta_cache):
+        with open(ruta_cache, encoding='utf-8') as f:
+            return f.read()
+
+    if directorio_fixtures is not None:
+        ruta_fixture = os.path.join(directorio_fixtures, nombre)
+        if os.path.exists(ruta_fixture):
+            with open(ruta_fixture, encoding='utf-8') as f:
+                texto = f.read()
+        else:
+            texto = json.dumps({'elements': []})
+    else:
+        caja = caja_tesela(tx, ty)
+        consulta = consulta_calles(caja) if tipo == 'calles' else api_osm.consulta_zonas_verdes(caja)
+        texto = api_osm.descargar_overpass(consulta)
+
+    guardar_texto(ruta_cache, texto)
+    return texto
+
+def guardar_texto(ruta, texto):
+    # Escritura atómica para que dos procesos no dejen una tesela a medias
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        f.write(texto)
+    os.replace(temporal, ruta)
+
+def distancia_metros(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA * math.asin(math.sqrt(a))
+
+def calles_desde_json(texto):
+    # Nodos y aristas (mismo esquema que nodos_burgos/aristas_burgos) a partir de la respuesta de Overpass
+    elementos = json.loads(texto).get('elements', [])
+    coordenadas = {e['id']: (e['lon'], e['lat']) for e in elementos if e['type'] == 'node'}
+    aristas = []
+    for way in (e for e in elementos if e['type'] == 'way'):
+        for u, v in zip(way['nodes'], way['nodes'][1:]):
+            if u in coordenadas and v in coordenadas and u != v:
+                (x1, y1), (x2, y2) = coordenadas[u], coordenadas[v]
+                aristas.append({'u': u, 'v': v, 'osmid_way': way['id'], 'length': distancia_metros(y1, x1, y2, x2),
+                                'geometry': LineString([coordenadas[u], coordenadas[v]])})
+    usados = {a['u'] for a in aristas} | {a['v'] for a in aristas}
+    nodos = [{'osmid': nodo, 'geometry': Point(coordenadas[nodo])} for nodo in usados]
+    nodos_gdf = gpd.GeoDataFrame(nodos, geometry='geometry', crs="EPSG:4326") if nodos else vacio(COLUMNAS_NODOS)
+    aristas_gdf = gpd.GeoDataFrame(aristas, geometry='geometry', crs="EPSG:4326") if aristas else vacio(COLUMNAS_ARISTAS)
+    return nodos_gdf, aristas_gdf
+
+def vacio(columnas):
+    # columnas: {nombre: dtype}; los ids de OSM son int64 también en las capas vacías
+    return gpd.GeoDataFrame({columna: np.empty(0, dtype=tipo) for columna, tipo in columnas.items()},
+                            geometry=[], crs="EPSG:4326")
+
+def unir_capas(gdfs, columnas):
+    # Las teselas sin elementos se leen del GeoJSON sin columnas (o con ids float64) y al concatenarlas
+    # convertirían en float todos los ids: se omiten
+    con_datos = [gdf for gdf in gdfs if not gdf.empty]
+    if not con_datos:
+        return vacio(columnas)
+    return pd.concat(con_datos, ignore_index=True).astype(columnas)
+
+def preparar_tesela(tx, ty, directorio_cache, directorio_fixtures=None):
+    # Descarga (si hace falta) y procesa una tesela, dejando en disco sus capas ya procesadas
+    directorio_tesela = os.path.join(directorio_cache, 'teselas', f"{tx}_{ty}")
+    rutas = {capa: os.path.join(directorio_tesela, archivo) for capa, archivo in
+             (('nodos', 'nodos.geojson'), ('aristas', 'aristas.geojson'), ('zonas_verdes', 'zonas_verdes.parquet'))}
+    if all(os.path.exists(ruta) for ruta in rutas.values()):
+        return rutas
+
+    nodos_gdf, aristas_gdf = calles_desde_json(
+        obtener_respuesta_cruda('calles', tx, ty, directorio_cache, directorio_fixtures))
+    zonas_verdes_gdf = api_osm.zonas_verdes_desde_json(
+        obtener_respuesta_cruda('zonas_verdes', tx, ty, directorio_cache, directorio_fixtures))
+
+    os.makedirs(directorio_tesela, exist_ok=True)
+    for capa, gdf in (('nodos', nodos_gdf), ('aristas', aristas_gdf)):
+        temporal = f"{rutas[capa]}.{os.getpid()}.tmp"
+        gdf.to_file(temporal, driver='GeoJSON')
+        os.replace(temporal, rutas[capa])
+    api_osm.guardar_zonas_verdes(zonas_verdes_gdf, rutas['zonas_verdes'])
+    return rutas
+
+def cargar_area(lat, lon, radio_km, directorio_cache, directorio_fixtures=None, max_workers=4):
+    # Grafo y zonas verdes de un radio, compuestos a partir de la unión de las teselas cacheadas
+    teselas = teselas_para_radio(lat, lon, radio_km)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        capas = list(pool.map(lambda t: preparar_tesela(t[0], t[1], directorio_cache, directorio_fixtures), teselas))
+
+    nodos_gdf = unir_capas([gpd.read_file(c['nodos']) for c in capas], COLUMNAS_NODOS).drop_duplicates('osmid')
+    aristas_gdf = unir_capas([gpd.read_file(c['aristas']) for c in capas], COLUMNAS_ARISTAS).drop_duplicates(['u', 'v'])
+    zonas_verdes_gdf = pd.concat([gpd.read_parquet(c['zonas_verdes']) for c in capas], ignore_index=True)
+    # Una zona verde que cruza varias teselas aparece en todas ellas
+    zonas_verdes_gdf = zonas_verdes_gdf[~zonas_verdes_gdf.geometry.to_wkb().duplicated()]
+
+    # Recortar al círculo pedido
+    radio_m = radio_km * 1000
+    dentro = np.array([distancia_metros(lat, lon, p.y, p.x) <= radio_m for p in nodos_gdf.geometry], dtype=bool)
+    nodos_gdf = nodos_gdf[dentro]
+    ids = set(nodos_gdf['osmid'])
+    aristas_gdf = aristas_gdf[aristas_gdf['u'].isin(ids) & aristas_gdf['v'].isin(ids)]
+    circulo = Point(lon, lat).buffer(radio_km / 111.32)
+    zonas_verdes_gdf = zonas_verdes_gdf[zonas_verdes_gdf.intersects(circulo)].reset_index(drop=True)
+
+    G = nx.Graph(crs='epsg:4326')
+    G.add_nodes_from((nodo, {'x': p.x, 'y': p.y}) for nodo, p in zip(nodos_gdf['osmid'], nodos_gdf.geometry))
+    G.add_edges_from((u, v, {'weight': longitud})
+                     for u, v, longitud in zip(aristas_gdf['u'], aristas_gdf['v'], aristas_gdf['length']))
+    return G, nodos_gdf.reset_index(drop=True), aristas_gdf.reset_index(drop=True), zonas_verdes_gdf
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Descarga por teselas y cachea calles y zonas verdes de OSM")
+    parser.add_argument('lat', type=float)
+    parser.add_argument('lon', type=float)
+    parser.add_argument('radio_km', type=float)
+    parser.add_argument('--cache', default='cache_osm')
+    parser.add_argument('--fixtures', default=None, help="Directorio con respuestas de Overpass en lugar de la API")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--salida', default=None, help="Prefijo para guardar nodos y aristas (GeoJSON) y zonas verdes (GeoParquet)")
+    args = parser.parse_args()
+
+    G, nodos_gdf, aristas_gdf, zonas_verdes_gdf = cargar_area(args.lat, args.lon, args.radio_km, args.cache,
+                                                              args.fixtures, args.workers)
+    print(f"{G.number_of_nodes()} nodos, {G.number_of_edges()} aristas, {len(zonas_verdes_gdf)} zonas verdes")
+    if args.salida:
+        nodos_gdf.to_file(f"{args.salida}_nodos.geojson", driver='GeoJSON')
+        aristas_gdf.to_file(f"{args.salida}_aristas.geojson", driver='GeoJSON')
+        api_osm.guardar_zonas_verdes(zonas_verdes_gdf, f"{args.salida}_parques.parquet")
@@ -1,56 +1,206 @@
-import folium
-import osmnx as ox
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+import numpy as np
 import geopandas as gpd
-from shapely.geometry import Point, Polygon
-import overpy
+import shapely
+from shapely.geometry import Point
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+# Etiquetas de OSM que se guardan como columnas; garden:type pasa a tipo_jardin, que es la columna que
+# miran las funciones de pesos para detectar dog parks junto con leisure
+COLUMNAS_ETIQUETAS = {'leisure': 'leisure', 'landuse': 'landuse', 'natural': 'natural', 'garden:type': 'tipo_jardin',
+                      'access': 'access', 'name': 'name'}
 
 def obtener_grafo_de_osm(lat, lon, radio_km):
+    import osmnx as ox
     punto_central = Point(lon, lat)
     poligono = punto_central.buffer(radio_km / 111.32)  # Aproximación de 1 grado de latitud ~= 111.32 km
     graph = ox.graph_from_polygon(poligono, network_type='all_private', simplify=False, retain_all=True)
     return graph
 
-def buscar_zonas_verdes(lat, lon, radio_km):
-    api = overpy.Overpass()
-    radio_m = radio_km * 1000
-    consulta = f"""
+def consulta_zonas_verdes(filtro_area):
+    # filtro_area es un filtro de Overpass, p. ej. "around:1000,40.41,-3.70" o una caja "sur,oeste,norte,este"
+    return f"""
     [out:json];
     (
         // Buscar por varias etiquetas de zonas verdes
-        way["leisure"~"park|nature_reserve|dog_park|garden"]["access"!="no"](around:{radio_m},{lat},{lon});
-        way["landuse"~"forest|village_green|grass"]["access"!="no"](around:{radio_m},{lat},{lon});
-        way["natural"~"scrub|heath"]["access"!="no"](around:{radio_m},{lat},{lon});
-        relation["leisure"~"park|nature_reserve|dog_park|garden"]["access"!="no"](around:{radio_m},{lat},{lon});
-        relation["landuse"~"forest|village_green|grass"]["access"!="no"](around:{radio_m},{lat},{lon});
-        relation["natural"~"scrub|heath"]["access"!="no"](around:{radio_m},{lat},{lon});
+        way["leisure"~"park|nature_reserve|dog_park|garden"]["access"!="no"]({filtro_area});
+        way["landuse"~"forest|village_green|grass"]["access"!="no"]({filtro_area});
+        way["natural"~"scrub|heath"]["access"!="no"]({filtro_area});
+        relation["leisure"~"park|nature_reserve|dog_park|garden"]["access"!="no"]({filtro_area});
+        relation["landuse"~"forest|village_green|grass"]["access"!="no"]({filtro_area});
+        relation["natural"~"scrub|heath"]["access"!="no"]({filtro_area});
     );
     (._;>;);
     out body;
     """
+
+def descargar_overpass(consulta, timeout=180):
+    # Respuesta JSON de Overpass como texto, sin pasar por los objetos de overpy
+    datos = urllib.parse.urlencode({'data': consulta}).encode()
+    with urllib.request.urlopen(OVERPASS_URL, data=datos, timeout=timeout) as respuesta:
+        return respuesta.read().decode('utf-8')
+
+def buscar_zonas_verdes(lat, lon, radio_km):
+    radio_m = radio_km * 1000
+    consulta = consulta_zonas_verdes(f"around:{radio_m},{lat},{lon}")
     try:
-        resultado = api.query(consulta)
-    except overpy.exception.OverpassBadRequest as e:
+        texto = descargar_overpass(consulta)
+    except urllib.error.HTTPError as e:
         print(f"Error en la consulta Overpass: {e}")
         return gpd.GeoDataFrame()
+    return zonas_verdes_desde_json(texto)
+
+def es_accesible(tags):
+    return tags.get('garden:type') != "private" and tags.get('barrier') is None and tags.get('access') != "no"
+
+def unir_anillos(caminos):
+    # Une por sus extremos los ways de un mismo rol de una relación hasta cerrar anillos (listas de ids de
+    # nodo). Los tramos que no llegan a cerrarse se descartan
+    anillos, abiertos = [], []
+    for camino in caminos:
+        if len(camino) >= 4 and camino[0] == camino[-1]:
+            anillos.append(list(camino))
+        elif len(camino) >= 2 and camino[0] != camino[-1]:
+            abiertos.append(camino)
+    extremos = defaultdict(list)
+    for i, camino in enumerate(abiertos):
+        extremos[camino[0]].append(i)
+        extremos[camino[-1]].append(i)
+    usados = [False] * len(abiertos)
+    for i, camino in enumerate(abiertos):
+        if usados[i]:
+            continue
+        usados[i] = True
+        anillo = list(camino)
+        while anillo[0] != anillo[-1]:
+            siguiente = next((j for j in extremos[anillo[-1]] if not usados[j]), None)
+            if siguiente is None:
+                break
+            usados[siguiente] = True
+            tramo = abiertos[siguiente]
+            anillo.extend(tramo[1:] if tramo[0] == anillo[-1] else tramo[-2::-1])
+        if anillo[0] == anillo[-1] and len(anillo) >= 4:
+            anillos.append(anillo)
+    return anillos
 
-    zonas_verdes = []
-    for elem in resultado.ways + resultado.relations:
-        tags = elem.tags
-        if tags.get('garden:type') != "private" and tags.get('barrier') is None and tags.get('access') != "no":
-            if isinstance(elem, overpy.Way):
-                nodos = elem.nodes
-            elif isinstance(elem, overpy.Relation):
-                nodos = [nodo.resolve() for nodo in elem.members if isinstance(nodo, overpy.RelationNode)]
-            else:
+def anillos_zonas_verdes(elementos):
+    # Anillos (listas de ids de nodo) de cada zona verde: un way etiquetado es un anillo exterior; una
+    # relación aporta sus anillos exteriores e interiores (role=inner) montados a partir de sus ways
+    ways = {e['id']: e.get('nodes', []) for e in elementos if e['type'] == 'way'}
+    zonas, anillos, zona_de_anillo, exterior = [], [], [], []
+    for e in elementos:
+        tags = e.get('tags')
+        if e['type'] not in ('way', 'relation') or not tags or not es_accesible(tags):
+            continue
+        if e['type'] == 'way':
+            nodos = e.get('nodes', [])
+            if len(nodos) <= 2:
                 continue
+            partes = [(True, nodos if nodos[0] == nodos[-1] else nodos + [nodos[0]])]
+        else:
+            miembros = [m for m in e.get('members', []) if m['type'] == 'way' and m['ref'] in ways]
+            partes = [(True, a) for a in unir_anillos([ways[m['ref']] for m in miembros if m.get('role') != 'inner'])]
+            partes += [(False, a) for a in unir_anillos([ways[m['ref']] for m in miembros if m.get('role') == 'inner'])]
+        if not any(es_exterior for es_exterior, _ in partes):
+            continue
+        for es_exterior, anillo in partes:
+            anillos.append(anillo)
+            zona_de_anillo.append(len(zonas))
+            exterior.append(es_exterior)
+        zonas.append((e['type'], e['id'], tags))
+    return zonas, anillos, np.array(zona_de_anillo, dtype=np.int64), np.array(exterior, dtype=bool)
+
+def geometrias_anillos(anillos, ids_nodos, coordenadas):
+    # Todos los LinearRing en una llamada a shapely.linearrings; los anillos con nodos que faltan en la
+    # respuesta se descartan. Devuelve los anillos y la máscara de los que se han podido construir
+    tamaños = np.array([len(anillo) for anillo in anillos], dtype=np.int64)
+    nodos = np.fromiter((nodo for anillo in anillos for nodo in anillo), dtype=np.int64, count=int(tamaños.sum()))
+    anillo_de_nodo = np.repeat(np.arange(len(anillos)), tamaños)
+    posiciones = np.minimum(np.searchsorted(ids_nodos, nodos), max(len(ids_nodos) - 1, 0))
+    encontrados = ids_nodos[posiciones] == nodos if len(ids_nodos) else np.zeros(len(nodos), dtype=bool)
+    completos = np.bincount(anillo_de_nodo, weights=~encontrados, minlength=len(anillos)) == 0
+    usados = completos[anillo_de_nodo]
+    if not usados.any():
+        return np.empty(0, dtype=object), completos
+    nuevo_indice = np.cumsum(completos) - 1
+    return shapely.linearrings(coordenadas[posiciones[usados]], indices=nuevo_indice[anillo_de_nodo[usados]]), completos
+
+def poligonos_validos(geometrias):
+    # Corrige las geometrías inválidas y se queda solo con su parte poligonal. make_valid puede reducir un
+    # anillo degenerado a una línea o un punto: devuelve también la máscara de las que siguen siendo
+    # Polygon o MultiPolygon no vacíos
+    invalidas = ~shapely.is_valid(geometrias)
+    geometrias[invalidas] = shapely.make_valid(geometrias[invalidas])
+    for i in np.flatnonzero(shapely.get_type_id(geometrias) == 7):  # GeometryCollection
+        partes = shapely.get_parts(geometrias[i])
+        geometrias[i] = shapely.union_all(partes[np.isin(shapely.get_type_id(partes), (3, 6))])
+    poligonales = np.isin(shapely.get_type_id(geometrias), (3, 6)) & ~shapely.is_empty(geometrias)
+    return geometrias, poligonales
+
+def zonas_verdes_desde_json(texto):
+    # Zonas verdes de una respuesta JSON de Overpass (texto o dict) con las geometrías construidas en
+    # bloque: ways cerrados como polígonos y relaciones multipolígono con sus anillos exteriores e interiores
+    datos = json.loads(texto) if isinstance(texto, (str, bytes)) else texto
+    elementos = datos.get('elements', [])
+    nodos = [e for e in elementos if e['type'] == 'node']
+    ids_nodos = np.array([e['id'] for e in nodos], dtype=np.int64)
+    coordenadas = np.array([(e['lon'], e['lat']) for e in nodos], dtype=np.float64).reshape(-1, 2)
+    orden = np.argsort(ids_nodos, kind='stable')
+    ids_nodos, coordenadas = ids_nodos[orden], coordenadas[orden]
+
+    zonas, anillos, zona_de_anillo, exterior = anillos_zonas_verdes(elementos)
+    columnas = ['osm_tipo', 'osm_id'] + list(COLUMNAS_ETIQUETAS.values())
+    vacio = gpd.GeoDataFrame({columna: np.empty(0, dtype=np.int64 if columna == 'osm_id' else object) for columna in columnas},
+                             geometry=[], crs="EPSG:4326")
+    if not anillos:
+        return vacio
+    geometrias_anillo, completos = geometrias_anillos(anillos, ids_nodos, coordenadas)
+    zona_de_anillo, exterior = zona_de_anillo[completos], exterior[completos]
+    if not exterior.any():
+        return vacio
+
+    # Cada anillo interior es un hueco del anillo exterior de su misma zona que lo contiene
+    exteriores = shapely.polygons(geometrias_anillo[exterior])
+    zona_exterior = zona_de_anillo[exterior]
+    interiores = geometrias_anillo[~exterior]
+    huecos, contenedores = shapely.STRtree(exteriores).query(shapely.polygons(interiores), predicate='within')
+    misma_zona = zona_de_anillo[~exterior][huecos] == zona_exterior[contenedores]
+    huecos, primeros = np.unique(huecos[misma_zona], return_index=True)
+    contenedores = contenedores[misma_zona][primeros]
+
+    # Polígonos con huecos en una llamada: para cada índice, primero el exterior y después sus huecos
+    indices = np.concatenate([np.arange(len(exteriores)), contenedores])
+    es_hueco = np.r_[np.zeros(len(exteriores), dtype=bool), np.ones(len(huecos), dtype=bool)]
+    orden = np.lexsort((es_hueco, indices))
+    poligonos = shapely.polygons(np.concatenate([geometrias_anillo[exterior], interiores[huecos]])[orden],
+                                 indices=indices[orden])
+
+    # Un multipolígono por zona; las zonas de un solo polígono se quedan como Polygon
+    zonas_con_geometria, zona_de_poligono = np.unique(zona_exterior, return_inverse=True)
+    geometrias = shapely.multipolygons(poligonos, indices=zona_de_poligono)
+    simples = shapely.get_num_geometries(geometrias) == 1
+    geometrias[simples] = shapely.get_geometry(geometrias[simples], 0)
+    geometrias, poligonales = poligonos_validos(geometrias)
 
-            if len(nodos) > 2:
-                poligono = Polygon([(float(nodo.lon), float(nodo.lat)) for nodo in nodos])
-                zonas_verdes.append(poligono)
+    datos = {'osm_tipo': [zonas[i][0] for i in zonas_con_geometria], 'osm_id': [zonas[i][1] for i in zonas_con_geometria]}
+    for etiqueta, columna in COLUMNAS_ETIQUETAS.items():
+        datos[columna] = [zonas[i][2].get(etiqueta) for i in zonas_con_geometria]
+    zonas_verdes_gdf = gpd.GeoDataFrame(datos, geometry=geometrias, crs="EPSG:4326")
+    return zonas_verdes_gdf[poligonales].reset_index(drop=True)
 
-    return gpd.GeoDataFrame(geometry=zonas_verdes, crs="EPSG:4326")
+def guardar_zonas_verdes(zonas_verdes_gdf, ruta):
+    # GeoParquet: columnar y con la geometría en WKB, se recarga mucho más rápido que un GeoJSON
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    zonas_verdes_gdf.to_parquet(temporal)
+    os.replace(temporal, ruta)
 
 def crear_mapa(lat, lon, radio_km, zonas_verdes, grafo):
+    import folium
     m = folium.Map(location=[lat, lon], zoom_start=15)
     for index, zona_verde in zonas_verdes.iterrows():
         folium.GeoJson(zona_verde.geometry, style_function=lambda feature: {
@@ -73,10 +223,12 @@ def crear_mapa(lat, lon, radio_km, zonas_verdes, grafo):
     m.save('mapa.html')
     print("Mapa generado exitosamente en mapa.html")
 
-# Ejemplo de uso de las funciones
-lat, lon = 40.4168, -3.7038  # Coordenadas de Madrid, España
-radio_km = 1
+if __name__ == "__main__":
+    # Ejemplo de uso de las funciones
+    lat, lon = 40.4168, -3.7038  # Coordenadas de Madrid, España
+    radio_km = 1
 
-grafo = obtener_grafo_de_osm(lat, lon, radio_km)
-zonas_verdes = buscar_zonas_verdes(lat, lon, radio_km)
-crear_mapa(lat, lon, radio_km, zonas_verdes, grafo)
+    grafo = obtener_grafo_de_osm(lat, lon, radio_km)
+    zonas_verdes = buscar_zonas_verdes(lat, lon, radio_km)
+    guardar_zonas_verdes(zonas_verdes, 'zonas_verdes.parquet')
+    crear_mapa(lat, lon, radio_km, zonas_verdes, grafo)
@@ -1,52 +1,94 @@
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+import numpy as np
+import distancias as dist
+import instrumentacion as instr
+import nodos_rutas_y_pesos as nrp
 
-def resolver_tsp(G, nodos):
-    # Crear la matriz de distancias
-    distancia_matrix = [[calcular_distancia_entre_nodos(G, i, j) for j in nodos] for i in nodos]
+COSTE_INALCANZABLE = 10 ** 9  # Coste para pares de nodos sin camino en la red
+
+def matriz_caminos_minimos(G, nodos):
+    from scipy.sparse.csgraph import dijkstra
+    # Dijkstra multi-origen en bloque sobre las longitudes de las calles: una fila por nodo de la lista
+    indice, _, _ = dist.coordenadas_nodos(G)
+    origenes = np.array([indice[nodo] for nodo in nodos], dtype=np.int64)
+    distancias_red, predecesores = dijkstra(dist.matriz_longitudes(G), directed=False, indices=origenes,
+                                            return_predecessors=True)
+    submatriz = distancias_red[:, origenes]
+    matriz = np.where(np.isfinite(submatriz), np.rint(submatriz), COSTE_INALCANZABLE).astype(np.int64)
+    return matriz, predecesores
+
+def resolver_tsp(G, nodos, tiempo_limite=1, busqueda_local_guiada=False, limite_soluciones=None):
+    # La búsqueda local guiada mejora la solución hasta que la para un límite: sin tiempo_limite ni
+    # limite_soluciones no terminaría nunca, y con ellos cada llamada consume el límite entero
+    if busqueda_local_guiada and tiempo_limite is None and limite_soluciones is None:
+        raise ValueError("La búsqueda local guiada necesita tiempo_limite o limite_soluciones")
+    from ortools.constraint_solver import routing_enums_pb2
+    from ortools.constraint_solver import pywrapcp
+    # Crear la matriz de distancias por la red de calles
+    with instr.etapa('matriz_caminos_minimos'):
+        distancia_matrix, predecesores = matriz_caminos_minimos(G, nodos)
 
     # Crear el manager de rutas y el modelo de routing
     manager = pywrapcp.RoutingIndexManager(len(distancia_matrix), 1, 0)
     routing = pywrapcp.RoutingModel(manager)
 
-    # Crear la función de distancia
-    def distancia_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return distancia_matrix[from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distancia_callback)
+    # Registrar la matriz directamente para que OR-Tools no llame a Python en cada arco
+    transit_callback_index = routing.RegisterTransitMatrix(distancia_matrix.tolist())
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     # Configurar parámetros de búsqueda
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.first_solution_strategy = (
         routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    if busqueda_local_guiada:
+        search_parameters.local_search_metaheuristic = (
+            routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+    if tiempo_limite is not None:
+        search_parameters.time_limit.FromMilliseconds(int(tiempo_limite * 1000))
+    if limite_soluciones is not None:
+        search_parameters.solution_limit = limite_soluciones
 
     # Resolver el problema
-    solution = routing.SolveWithParameters(search_parameters)
+    with instr.etapa('ortools'):
+        solution = routing.SolveWithParameters(search_parameters)
     if not solution:
         return None
 
-    # Extraer la ruta
+    # Extraer el orden de visita
     index = routing.Start(0)
-    ruta_optima = []
+    orden_visita = []
     while not routing.IsEnd(index):
-        ruta_optima.append(manager.IndexToNode(index))
+        orden_visita.append(manager.IndexToNode(index))
         index = solution.Value(routing.NextVar(index))
-    ruta_optima.append(manager.IndexToNode(index))
+    orden_visita.append(manager.IndexToNode(index))
 
+    # Expandir cada tramo con su camino mínimo para devolver una ruta de nodos adyacentes
+    indice, _, _ = dist.coordenadas_nodos(G)
+    nodos_grafo = list(G.nodes)
+    ruta_optima = [nodos[orden_visita[0]]]
+    for i, j in zip(orden_visita, orden_visita[1:]):
+        if i == j or distancia_matrix[i, j] >= COSTE_INALCANZABLE:
+            continue
+        camino = dist.reconstruir_camino(predecesores[i], indice[nodos[j]])
+        ruta_optima.extend(nodos_grafo[k] for k in camino[1:])
     return ruta_optima
 
-def generar_rutas(G, nodo_inicio, duracion, perfil_perro, zonas_verdes_gdf):
-    distancia_estimada = calcular_distancia(duracion, perfil_perro)
-    
+def generar_rutas(G, nodo_inicio, duracion, perfil_perro, zonas_verdes_gdf, distancia_umbral=30, max_nodos=25):
+    distancia_estimada = nrp.estimar_distancia(duracion, perfil_perro)
+
     # Identificar nodos cercanos a zonas verdes u otros puntos de interés
-    nodos_interes = identificar_nodos_cercanos(G, zonas_verdes_gdf, distancia_umbral=distancia_estimada)
+    nodos_interes = identificar_nodos_cercanos(G, zonas_verdes_gdf, distancia_umbral=distancia_umbral)
+
+    # Quedarse con los más cercanos al inicio que quepan en una ida y vuelta del paseo
+    if nodos_interes:
+        distancias_inicio = dist.matriz_distancias(G, [nodo_inicio] + nodos_interes, usar_aristas=False)[0, 1:]
+        alcanzables = np.flatnonzero(distancias_inicio <= distancia_estimada / 2)
+        alcanzables = alcanzables[np.argsort(distancias_inicio[alcanzables], kind='stable')][:max_nodos]
+        nodos_interes = [nodos_interes[i] for i in alcanzables]
 
     # Incluir el nodo de inicio en la lista de nodos a visitar
-    if nodo_inicio not in nodos_interes:
-        nodos_interes.insert(0, nodo_inicio)
+    if nodo_inicio in nodos_interes:
+        nodos_interes.remove(nodo_inicio)
+    nodos_interes.insert(0, nodo_inicio)
 
     # Resolver TSP para encontrar la ruta óptima
     ruta_optima = resolver_tsp(G, nodos_interes)
@@ -54,6 +96,14 @@ def generar_rutas(G, nodo_inicio, duracion, perfil_perro, zonas_verdes_gdf):
     return ruta_optima
 
 def identificar_nodos_cercanos(G, zonas_verdes_gdf, distancia_umbral):
-    # Esta función debe identificar nodos dentro de una cierta distancia de las zonas verdes
-    # y devolver una lista de esos nodos. La implementación depende de tus datos y criterios específicos.
-    pass
+    import shapely
+    # Nodos a menos de distancia_umbral metros de alguna zona verde, usando el índice espacial de las zonas
+    if zonas_verdes_gdf.empty or G.number_of_nodes() == 0:
+        return []
+    _, lat, lon = dist.coordenadas_nodos(G)
+    puntos = shapely.points(lon, lat)
+    # Las zonas verdes están en grados (EPSG:4326): se convierte el umbral con la longitud de un grado de latitud
+    grados = distancia_umbral / 111320
+    indices_puntos, _ = zonas_verdes_gdf.sindex.query(puntos, predicate='dwithin', distance=grados)
+    nodos_grafo = list(G.nodes)
+    return [nodos_grafo[i] for i in np.unique(indices_puntos)]
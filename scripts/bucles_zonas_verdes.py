@@ -0,0 +1,105 @@
+import math
+import time
+import numpy as np
+from scipy.sparse import csr_array
+from scipy.sparse.csgraph import dijkstra
+import distancias as dist
+import instrumentacion as instr
+import nodos_rutas_y_pesos as nrp
+
+METROS_POR_GRADO = 111320  # Las distancias a zonas verdes se miden en grados (EPSG:4326)
+
+def nodos_zonas_verdes(G, zonas_verdes_gdf, distancia_umbral=30):
+    # Índices de los nodos a menos de distancia_umbral metros de alguna zona verde, calculados una vez por grafo
+    cache = G.graph.get('nodos_zonas_verdes')
+    if (cache is None or cache[0] is not zonas_verdes_gdf or cache[1] != distancia_umbral
+            or cache[2] != G.number_of_nodes()):
+        distancias_nodos = nrp.distancias_nodos_zonas_verdes(G, zonas_verdes_gdf)
+        verdes = np.flatnonzero(distancias_nodos * METROS_POR_GRADO <= distancia_umbral)
+        cache = (zonas_verdes_gdf, distancia_umbral, G.number_of_nodes(), verdes)
+        G.graph['nodos_zonas_verdes'] = cache
+    return cache[3]
+
+def penalizar(matriz, caminos, factor_penalizacion):
+    # Copia de los pesos (la estructura CSR se comparte) con las aristas de los caminos encarecidas en ambos sentidos
+    datos = matriz.data.copy()
+    for camino in caminos:
+        for u, v in zip(camino, camino[1:]):
+            for a, b in ((u, v), (v, u)):
+                inicio = matriz.indptr[a]
+                posicion = inicio + np.flatnonzero(matriz.indices[inicio:matriz.indptr[a + 1]] == b)
+                datos[posicion] = matriz.data[posicion] * factor_penalizacion
+    return csr_array((datos, matriz.indices, matriz.indptr), shape=matriz.shape)
+
+def elegir_waypoints(candidatos, desvios, lat, lon, origen, max_waypoints):
+    # El candidato más cercano a la distancia buscada en cada sector angular alrededor del inicio,
+    # para que los bucles salgan en direcciones distintas
+    angulos = np.arctan2(lat[candidatos] - lat[origen], (lon[candidatos] - lon[origen]) * math.cos(math.radians(lat[origen])))
+    sectores = ((angulos + math.pi) / (2 * math.pi) * max_waypoints).astype(np.int64) % max_waypoints
+    orden = np.lexsort((desvios, sectores))
+    primeros = orden[np.r_[True, sectores[orden][1:] != sectores[orden][:-1]]]
+    return candidatos[primeros[np.argsort(desvios[primeros], kind='stable')]]
+
+def generar_bucles(G, nodo_inicio, distancia_objetivo, zonas_verdes_gdf, max_rutas=5, max_waypoints=8, tolerancia=0.35,
+                   factor_penalizacion=3.0, distancia_umbral=30, tiempo_max=0.5):
+    # Bucles de unos distancia_objetivo metros: inicio -> zona verde A -> zona verde B -> inicio, con A y B a
+    # aproximadamente un tercio de la distancia. Cada tramo es un camino mínimo por longitud de calle y las
+    # aristas ya recorridas se penalizan para que la vuelta no repita la ida. El número de Dijkstra (acotados
+    # por distancia) está limitado por max_waypoints, así que la latencia no depende de enumerar ciclos
+    limite_tiempo = time.perf_counter() + tiempo_max
+    indice, lat, lon = dist.coordenadas_nodos(G)
+    origen = indice[nodo_inicio]
+    matriz = dist.matriz_longitudes(G)
+    tramo = distancia_objetivo / 3
+    distancias_inicio, predecesores_inicio = dijkstra(matriz, indices=origen, limit=distancia_objetivo / 2,
+                                                      return_predecessors=True)
+
+    # Candidatos: nodos junto a zonas verdes alcanzables; si no hay, cualquier nodo alcanzable
+    candidatos = nodos_zonas_verdes(G, zonas_verdes_gdf, distancia_umbral)
+    candidatos = candidatos[np.isfinite(distancias_inicio[candidatos]) & (candidatos != origen)]
+    if len(candidatos) == 0:
+        candidatos = np.flatnonzero(np.isfinite(distancias_inicio))
+        candidatos = candidatos[candidatos != origen]
+    if len(candidatos) == 0:
+        return []
+    desvios = np.abs(distancias_inicio[candidatos] - tramo) / tramo
+    en_anillo = desvios <= tolerancia
+    if en_anillo.any():
+        candidatos, desvios = candidatos[en_anillo], desvios[en_anillo]
+    waypoints = elegir_waypoints(candidatos, desvios, lat, lon, origen, max_waypoints)
+    instr.contar('waypoints', len(waypoints))
+
+    caminos = []
+    for a in waypoints.tolist():
+        if caminos and time.perf_counter() > limite_tiempo:
+            break
+        tramos = [dist.reconstruir_camino(predecesores_inicio, a)]
+
+        # Segundo waypoint: el que deja el bucle estimado (ida + A->B + vuelta en línea de red) más cerca del objetivo
+        distancias_a, predecesores_a = dijkstra(penalizar(matriz, tramos, factor_penalizacion), indices=a,
+                                                limit=distancia_objetivo / 2, return_predecessors=True)
+        alcanzables = candidatos[np.isfinite(distancias_a[candidatos]) & (candidatos != a)]
+        if len(alcanzables):
+            totales = distancias_inicio[a] + distancias_a[alcanzables] + distancias_inicio[alcanzables]
+            b = int(alcanzables[np.argmin(np.abs(totales - distancia_objetivo))])
+            tramos.append(dist.reconstruir_camino(predecesores_a, b))
+
+        # Vuelta al inicio evitando en lo posible las aristas ya recorridas
+        distancias_vuelta, predecesores_vuelta = dijkstra(penalizar(matriz, tramos, factor_penalizacion),
+                                                          indices=tramos[-1][-1], limit=distancia_objetivo,
+                                                          return_predecessors=True)
+        if not np.isfinite(distancias_vuelta[origen]):
+            continue
+        tramos.append(dist.reconstruir_camino(predecesores_vuelta, origen))
+        camino = tramos[0] + [nodo for t in tramos[1:] for nodo in t[1:]]
+        if camino not in caminos:
+            caminos.append(camino)
+
+    if not caminos:
+        return []
+    # Nodos del grafo y orden por cercanía a la distancia objetivo
+    nodos_grafo = G.osmid if getattr(G, 'compacto', False) else np.array(list(G.nodes), dtype=object)
+    rutas = [nodos_grafo[camino].tolist() for camino in caminos]
+    longitudes = nrp.longitudes_rutas(rutas, G)
+    orden = np.argsort(np.abs(longitudes - distancia_objetivo), kind='stable')[:max_rutas]
+    return [rutas[i] for i in orden]
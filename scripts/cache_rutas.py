@@ -0,0 +1,130 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import instrumentacion as instr
+import nodos_rutas_y_pesos as nrp
+import velocidad_y_distancia as vd
+
+class CacheRutas:
+    # Caché de rutas en dos niveles: LRU en memoria con caducidad y, opcionalmente, SQLite compartido entre procesos
+    def __init__(self, max_entradas=1024, ttl=3600, intervalo_duracion=5, ruta_sqlite=None):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.intervalo_duracion = intervalo_duracion
+        self.memoria = OrderedDict()
+        self.lock = threading.Lock()
+        self.aciertos_memoria = 0
+        self.aciertos_disco = 0
+        self.fallos = 0
+        self.conexion = None
+        if ruta_sqlite:
+            self.conexion = sqlite3.connect(ruta_sqlite, timeout=10, check_same_thread=False)
+            self.conexion.execute('PRAGMA journal_mode=WAL')
+            self.conexion.execute('CREATE TABLE IF NOT EXISTS rutas '
+                                  '(clave TEXT PRIMARY KEY, version TEXT, valor TEXT, instante REAL)')
+            self.conexion.commit()
+
+    def redondear_duracion(self, duracion):
+        return max(self.intervalo_duracion, round(duracion / self.intervalo_duracion) * self.intervalo_duracion)
+
+    def clave(self, version_grafo, nodo_inicio, duracion, perfil_perro, estrategia='ciclos'):
+        # Perros con la misma velocidad y los mismos factores de puntuación comparten ruta (si se generó
+        # con la misma estrategia)
+        velocidad = vd.estimar_velocidad(perfil_perro.get('raza'))
+        factor_tamaño, factor_edad = nrp.factores_perfil(perfil_perro)
+        return (version_grafo, nodo_inicio, self.redondear_duracion(duracion), velocidad, factor_tamaño, factor_edad,
+                estrategia)
+
+    def obtener(self, clave):
+        ahora = time.time()
+        with self.lock:
+            entrada = self.memoria.get(clave)
+            if entrada is not None:
+                valor, instante = entrada
+                if ahora - instante <= self.ttl:
+                    self.memoria.move_to_end(clave)
+                    self.aciertos_memoria += 1
+                    instr.contar('cache_aciertos_memoria')
+                    return valor
+                del self.memoria[clave]
+
+            if self.conexion is not None:
+                fila = self.conexion.execute('SELECT valor, instante FROM rutas WHERE clave = ?',
+                                             (json.dumps(clave),)).fetchone()
+                if fila is not None and ahora - fila[1] <= self.ttl:
+                    valor = json.loads(fila[0])
+                    self.guardar_en_memoria(clave, valor, fila[1])
+                    self.aciertos_disco += 1
+                    instr.contar('cache_aciertos_disco')
+                    return valor
+            self.fallos += 1
+            instr.contar('cache_fallos')
+        return None
+
+    def guardar(self, clave, valor):
+        ahora = time.time()
+        with self.lock:
+            self.guardar_en_memoria(clave, valor, ahora)
+            if self.conexion is not None:
+                self.conexion.execute('INSERT OR REPLACE INTO rutas VALUES (?, ?, ?, ?)',
+                                      (json.dumps(clave), clave[0], json.dumps(valor), ahora))
+                self.conexion.commit()
+
+    def guardar_en_memoria(self, clave, valor, instante):
+        # Llamar con el lock tomado; expulsa la entrada usada hace más tiempo si se supera el tamaño
+        self.memoria[clave] = (valor, instante)
+        self.memoria.move_to_end(clave)
+        while len(self.memoria) > self.max_entradas:
+            self.memoria.popitem(last=False)
+
+    def invalidar(self, version_vigente=None):
+        # Elimina las rutas de versiones del grafo distintas de la vigente (o todas si no se indica).
+        # Con varias regiones se pasa la lista de versiones vigentes
+        vigentes = None if version_vigente is None else (
+            {version_vigente} if isinstance(version_vigente, str) else set(version_vigente))
+        with self.lock:
+            for clave in [c for c in self.memoria if vigentes is None or c[0] not in vigentes]:
+                del self.memoria[clave]
+            if self.conexion is not None:
+                if vigentes is None:
+                    self.conexion.execute('DELETE FROM rutas')
+                else:
+                    marcadores = ', '.join('?' * len(vigentes))
+                    self.conexion.execute(f'DELETE FROM rutas WHERE version NOT IN ({marcadores})', tuple(vigentes))
+                self.conexion.commit()
+
+    def estadisticas(self):
+        with self.lock:
+            consultas = self.aciertos_memoria + self.aciertos_disco + self.fallos
+            return {
+                'entradas_memoria': len(self.memoria),
+                'aciertos_memoria': self.aciertos_memoria,
+                'aciertos_disco': self.aciertos_disco,
+                'fallos': self.fallos,
+                'tasa_aciertos': (self.aciertos_memoria + self.aciertos_disco) / consultas if consultas else 0.0,
+            }
+
+    def cerrar(self):
+        if self.conexion is not None:
+            self.conexion.close()
+            self.conexion = None
+
+def generar_rutas_con_cache(cache, G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf,
+                            estrategia='ciclos', generar=nrp.generar_rutas):
+    # Punto de entrada común de main y del servicio. generar tiene la firma de nrp.generar_rutas y solo se
+    # llama si la ruta no está en la caché. Sin caché o sin versión (grafo modificado fuera del artefacto
+    # compilado) no se puede reutilizar nada
+    version = G.graph.get('version')
+    if cache is None or version is None:
+        return generar(G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf, estrategia)
+
+    clave = cache.clave(version, nodo_mas_cercano, duracion_paseo, perfil_perro, estrategia)
+    with instr.etapa('cache'):
+        rutas = cache.obtener(clave)
+    if rutas is None:
+        # Se calcula con la duración redondeada para que la ruta guardada sirva a toda la clave
+        rutas = generar(G, nodo_mas_cercano, clave[2], perfil_perro, zonas_verdes_gdf, estrategia)
+        cache.guardar(clave, rutas)
+    return rutas
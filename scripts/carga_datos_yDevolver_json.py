@@ -1,36 +1,37 @@
-import geopandas as gpd
-from shapely.ops import nearest_points
 import json
-from nodos_rutas_y_pesos import crear_grafo_desde_geojson
-import osmnx as ox
+import sys
+import salida_rutas
+
+CAMPOS_PERRO = ('latitud', 'longitud', 'tamaño', 'edad', 'raza', 'duracion')
+CAMPOS_NUMERICOS = ('latitud', 'longitud', 'edad', 'duracion')
 
 def cargar_datos_geojson(nombre_archivo_nodos, nombre_archivo_aristas):
+    import geopandas as gpd
     # Cargar datos de nodos y aristas desde archivos GeoJSON
-    nodos_gdf = gpd.read_file('nodos_burgos.geojson')
-    aristas_gdf = gpd.read_file('aristas_burgos.geojson')
+    nodos_gdf = gpd.read_file(nombre_archivo_nodos)
+    aristas_gdf = gpd.read_file(nombre_archivo_aristas)
     return nodos_gdf, aristas_gdf
 
 def zonas_verdes_gdf(nombre_archivo_zonas_verdes):
-    zonas_verdes_gdf = gpd.read_file('parques.geojson')
+    import geopandas as gpd
+    # GeoParquet (lo que escribe la ingesta de OSM) o cualquier formato que lea geopandas
+    if nombre_archivo_zonas_verdes.endswith('.parquet'):
+        return gpd.read_parquet(nombre_archivo_zonas_verdes)
+    zonas_verdes_gdf = gpd.read_file(nombre_archivo_zonas_verdes)
     return zonas_verdes_gdf
     
 def obtener_ubicacion_actual(G, latitud, longitud):
-    return ox.nearest_nodes(G, longitud, latitud)
-
-def generar_json_respuesta(rutas, nombre_archivo_mapa, json_input):
-    # Convertir la ruta en una lista de diccionarios
-    ruta = [{'lat': nodo[0], 'lon': nodo[1]} for nodo in rutas]
-
-    # Cargar los datos del perro
+    # Acepta un punto o listas de latitudes y longitudes; el índice espacial se construye una vez por grafo
+    import indice_espacial
+    nodos, _ = indice_espacial.indice_espacial(G).ajustar(latitud, longitud)
+    if isinstance(latitud, (list, tuple)) or getattr(latitud, 'ndim', 0) > 0:
+        return nodos.tolist()
+    return nodos[0]
+
+def generar_json_respuesta(ruta, nombre_archivo_mapa, json_input, G, traza=None):
+    # La ruta es una lista de nodos: sus coordenadas se leen de los arrays del grafo
     datos_perro = cargar_datos_perro(json_input)
-
-    # Añadir la ruta a los datos del perro
-    datos_perro['ruta'] = ruta
-
-    # Convertir los datos a JSON
-    respuesta_json = json.dumps(datos_perro)
-
-    return respuesta_json
+    return salida_rutas.respuesta_ruta(G, ruta, datos_perro, nombre_archivo_mapa, traza)
 
 def cargar_datos_perro(json_input):
     try:
@@ -38,6 +39,20 @@ def cargar_datos_perro(json_input):
         datos_perro = json.loads(json_input)
         return datos_perro
     except json.JSONDecodeError as e:
-        print(f"Error al decodificar el JSON: {e}")
+        # Por stderr: stdout lleva las respuestas JSON del servicio y de la planificación en lote
+        print(f"Error al decodificar el JSON: {e}", file=sys.stderr)
         return None
+
+def error_datos_perro(datos_perro):
+    # Mensaje de error si faltan campos o no son del tipo esperado; None si el perro se puede planificar
+    if not isinstance(datos_perro, dict):
+        return "No se pudieron cargar los datos del perro."
+    faltan = [campo for campo in CAMPOS_PERRO if campo not in datos_perro]
+    if faltan:
+        return f"Faltan campos en los datos del perro: {', '.join(faltan)}"
+    no_numericos = [campo for campo in CAMPOS_NUMERICOS
+                    if isinstance(datos_perro[campo], bool) or not isinstance(datos_perro[campo], (int, float))]
+    if no_numericos:
+        return f"Campos no numéricos en los datos del perro: {', '.join(no_numericos)}"
+    return None
     
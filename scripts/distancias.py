@@ -0,0 +1,166 @@
+import math
+import numpy as np
+
+RADIO_TIERRA = 6371008.8  # Radio medio de la Tierra en metros
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Distancia de gran círculo en metros; acepta escalares o arrays de NumPy (con broadcasting)
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA * np.arcsin(np.sqrt(a))
+
+def equirectangular(lat1, lon1, lat2, lon2):
+    # Aproximación plana, suficiente a escala de barrio y más barata que haversine
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    x = (lon2 - lon1) * np.cos((lat1 + lat2) / 2)
+    return RADIO_TIERRA * np.hypot(x, lat2 - lat1)
+
+def geodesica(lat1, lon1, lat2, lon2):
+    # Distancia geodésica exacta (geopy); lenta, para cuando la precisión importa
+    from geopy.distance import distance
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+    resultado = np.array([distance((a, b), (c, d)).meters
+                          for a, b, c, d in zip(lat1.ravel(), lon1.ravel(), lat2.ravel(), lon2.ravel())])
+    return resultado.reshape(lat1.shape)
+
+KERNELS = {'haversine': haversine, 'equirectangular': equirectangular, 'geodesica': geodesica}
+
+def haversine_escalar(lat1, lon1, lat2, lon2):
+    # Versión con math para pares sueltos, sin el coste de crear arrays
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA * math.asin(math.sqrt(a))
+
+def proyectar_equirectangular(lat, lon, lat_origen, lon_origen):
+    # Coordenadas planas en metros alrededor del origen (equirectangular local), una fila (x, y) por punto
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    x = np.radians(lon - lon_origen) * math.cos(math.radians(lat_origen)) * RADIO_TIERRA
+    y = np.radians(lat - lat_origen) * RADIO_TIERRA
+    return np.column_stack([np.ravel(x), np.ravel(y)])
+
+def coordenadas_nodos(G):
+    # Arrays de latitud/longitud de los nodos y su índice, calculados una vez por grafo
+    if getattr(G, 'compacto', False):
+        return G.indice, G.y, G.x
+    cache = G.graph.get('coordenadas_nodos')
+    if cache is None or len(cache[0]) != G.number_of_nodes():
+        indice = {nodo: i for i, nodo in enumerate(G.nodes)}
+        lat = np.array([data['y'] for _, data in G.nodes(data=True)], dtype=np.float64)
+        lon = np.array([data['x'] for _, data in G.nodes(data=True)], dtype=np.float64)
+        cache = (indice, lat, lon)
+        G.graph['coordenadas_nodos'] = cache
+    return cache
+
+def longitud_arista(data):
+    # Longitud base de una arista de networkx; 'weight' lleva además las reducciones por zonas verdes
+    return data.get('longitud', data['weight'])
+
+def distancia_entre_nodos(G, nodo1, nodo2, precision='haversine', usar_aristas=True):
+    # Si los nodos son adyacentes se usa la longitud de la arista ya almacenada en el grafo
+    if getattr(G, 'compacto', False):
+        longitud = G.longitud(nodo1, nodo2) if usar_aristas else None
+        if longitud is not None:
+            return longitud
+        i, j = G.indice[nodo1], G.indice[nodo2]
+        y1, x1, y2, x2 = float(G.y[i]), float(G.x[i]), float(G.y[j]), float(G.x[j])
+    else:
+        if usar_aristas and G.has_edge(nodo1, nodo2):
+            return longitud_arista(G[nodo1][nodo2])
+        y1, x1 = G.nodes[nodo1]['y'], G.nodes[nodo1]['x']
+        y2, x2 = G.nodes[nodo2]['y'], G.nodes[nodo2]['x']
+    if precision == 'haversine':
+        return haversine_escalar(y1, x1, y2, x2)
+    return float(KERNELS[precision](y1, x1, y2, x2))
+
+def vecinos_aristas(G, nodo):
+    # Tuplas (vecino, longitud, peso) de las aristas de un nodo: la longitud para medir distancias y el
+    # peso (reducido cerca de zonas verdes) solo para ordenar por preferencia
+    if getattr(G, 'compacto', False):
+        return G.vecinos_aristas(nodo)
+    return ((vecino, longitud_arista(data), data['weight']) for vecino, data in G[nodo].items())
+
+def matriz_distancias(G, nodos, precision='haversine', usar_aristas=True):
+    # Matriz completa de distancias entre los nodos indicados, en una sola operación vectorizada
+    indice, lat, lon = coordenadas_nodos(G)
+    posiciones = np.array([indice[nodo] for nodo in nodos], dtype=np.int64)
+    lat, lon = lat[posiciones], lon[posiciones]
+    matriz = KERNELS[precision](lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+    if usar_aristas:
+        posicion_en_lista = {nodo: i for i, nodo in enumerate(nodos)}
+        for i, nodo in enumerate(nodos):
+            for vecino, data in G[nodo].items():
+                j = posicion_en_lista.get(vecino)
+                if j is not None and j != i:
+                    matriz[i, j] = longitud_arista(data)
+    return matriz
+
+def matriz_adyacencia(G):
+    # Adyacencia CSR con los pesos de preferencia (reducidos cerca de zonas verdes) en el mismo orden de nodos
+    # que coordenadas_nodos, calculada una vez por grafo. No son distancias: para medir, matriz_longitudes
+    adyacencia = G.graph.get('adyacencia_csr')
+    if adyacencia is None:
+        if getattr(G, 'compacto', False):
+            from scipy.sparse import csr_array
+            adyacencia = csr_array((G.pesos, G.vecinos, G.inicio_vecinos), shape=(len(G), len(G)))
+        else:
+            import networkx as nx
+            adyacencia = nx.to_scipy_sparse_array(G, nodelist=list(G.nodes), weight='weight', format='csr')
+        G.graph['adyacencia_csr'] = adyacencia
+    return adyacencia
+
+def matriz_longitudes(G):
+    # Misma estructura que matriz_adyacencia pero con la longitud base de cada arista (sin reducciones por
+    # zonas verdes); las longitudes nulas se sustituyen por un valor mínimo para no perder la arista
+    longitudes = G.graph.get('longitudes_csr')
+    if longitudes is None:
+        from scipy.sparse import csr_array
+        if getattr(G, 'compacto', False):
+            longitudes = csr_array((np.maximum(G.longitudes, 1e-6), G.vecinos, G.inicio_vecinos), shape=(len(G), len(G)))
+        else:
+            indice, _, _ = coordenadas_nodos(G)
+            filas, columnas, valores = [], [], []
+            for u, v, data in G.edges(data=True):
+                sentidos = [(indice[u], indice[v])] if u == v else [(indice[u], indice[v]), (indice[v], indice[u])]
+                for fila, columna in sentidos:
+                    filas.append(fila)
+                    columnas.append(columna)
+                    valores.append(max(longitud_arista(data), 1e-6))
+            longitudes = csr_array((valores, (filas, columnas)), shape=(len(indice), len(indice)))
+        G.graph['longitudes_csr'] = longitudes
+    return longitudes
+
+def reconstruir_camino(predecesores_origen, destino):
+    # Camino (en índices de nodo) desde el origen de una fila de predecesores de scipy hasta destino
+    camino = [destino]
+    while predecesores_origen[camino[-1]] >= 0:
+        camino.append(predecesores_origen[camino[-1]])
+    return camino[::-1]
+
+def factor_cota_inferior(G):
+    # Menor cociente longitud / distancia en línea recta de las aristas del grafo (1 salvo longitudes
+    # guardadas más cortas que la recta). Multiplicado por la distancia en línea recta da una cota inferior
+    # válida de la distancia por la red
+    factor = G.graph.get('factor_cota_inferior')
+    if factor is None:
+        _, lat, lon = coordenadas_nodos(G)
+        adyacencia = matriz_longitudes(G)
+        u = np.repeat(np.arange(adyacencia.shape[0]), np.diff(adyacencia.indptr))
+        v, longitudes = adyacencia.indices, adyacencia.data
+        factor = 1.0
+        if len(u):
+            rectas = haversine(lat[u], lon[u], lat[v], lon[v])
+            validas = rectas > 0
+            if validas.any():
+                factor = min(1.0, float((longitudes[validas] / rectas[validas]).min()))
+        G.graph['factor_cota_inferior'] = factor
+    return factor
+
+def invalidar_cache(G):
+    # Llamar cuando cambian nodos o pesos del grafo; la versión del artefacto compilado deja de ser válida
+    G.graph.pop('version', None)
+    G.graph.pop('coordenadas_nodos', None)
+    G.graph.pop('factor_cota_inferior', None)
+    G.graph.pop('adyacencia_csr', None)
+    G.graph.pop('longitudes_csr', None)
+    if getattr(G, 'compacto', False):
+        G.cache_vecinos.clear()
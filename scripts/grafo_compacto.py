@@ -0,0 +1,174 @@
+import numpy as np
+
+class VistaNodos:
+    # Imitación mínima de G.nodes de networkx: iteración, pertenencia y G.nodes[n]['x'] / ['y']
+    def __init__(self, grafo):
+        self.grafo = grafo
+
+    def __iter__(self):
+        return iter(self.grafo.osmid.tolist())
+
+    def __len__(self):
+        return len(self.grafo.osmid)
+
+    def __contains__(self, nodo):
+        return nodo in self.grafo.indice
+
+    def __getitem__(self, nodo):
+        i = self.grafo.indice[nodo]
+        return {'x': float(self.grafo.x[i]), 'y': float(self.grafo.y[i])}
+
+    def __call__(self, data=False):
+        if not data:
+            return iter(self)
+        return ((nodo, {'x': x, 'y': y})
+                for nodo, x, y in zip(self.grafo.osmid.tolist(), self.grafo.x.tolist(), self.grafo.y.tolist()))
+
+class GrafoCompacto:
+    # Grafo no dirigido de solo lectura guardado en arrays de NumPy con adyacencia CSR (cada arista en
+    # ambos sentidos, los lazos una sola vez). Ofrece la parte de la API de networkx que usan los módulos de rutas
+    compacto = True
+
+    def __init__(self, osmid, x, y, inicio_vecinos, vecinos, pesos, es_dog_park=None, distancia_zona_verde=None,
+                 graph=None, longitudes=None, coordenadas_proyectadas=None):
+        self.osmid = np.asarray(osmid)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.inicio_vecinos = np.asarray(inicio_vecinos)
+        self.vecinos = np.asarray(vecinos)
+        self.pesos = np.asarray(pesos, dtype=np.float64)
+        # Longitud base de cada arista; los pesos se derivan de ella con las reducciones por zonas verdes
+        self.longitudes = self.pesos if longitudes is None else np.asarray(longitudes, dtype=np.float64)
+        self.es_dog_park = np.zeros(len(self.vecinos), dtype=bool) if es_dog_park is None else np.asarray(es_dog_park)
+        self.distancia_zona_verde = (np.full(len(self.vecinos), np.inf) if distancia_zona_verde is None
+                                     else np.asarray(distancia_zona_verde))
+        # Coordenadas en metros del artefacto compilado (origen en graph['origen_proyeccion']) para el KD-tree
+        self.coordenadas_proyectadas = coordenadas_proyectadas
+        self.indice = {nodo: i for i, nodo in enumerate(self.osmid.tolist())}
+        self.graph = dict(graph or {})
+        self.nodes = VistaNodos(self)
+        # Listas (vecino, longitud, peso) de los nodos ya visitados: las búsquedas vuelven muchas veces a los
+        # mismos nodos y cortar arrays de NumPy en cada visita es más lento que iterar una lista
+        self.cache_vecinos = {}
+
+    def __len__(self):
+        return len(self.osmid)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __contains__(self, nodo):
+        return nodo in self.indice
+
+    def number_of_nodes(self):
+        return len(self.osmid)
+
+    def number_of_edges(self):
+        origen = np.repeat(np.arange(len(self.osmid)), np.diff(self.inicio_vecinos))
+        return int(np.count_nonzero(origen <= self.vecinos))
+
+    def tramo(self, nodo):
+        i = self.indice[nodo]
+        return self.inicio_vecinos[i], self.inicio_vecinos[i + 1]
+
+    def neighbors(self, nodo):
+        a, b = self.tramo(nodo)
+        return iter(self.osmid[self.vecinos[a:b]].tolist())
+
+    def vecinos_aristas(self, nodo):
+        vecinos = self.cache_vecinos.get(nodo)
+        if vecinos is None:
+            a, b = self.tramo(nodo)
+            vecinos = list(zip(self.osmid[self.vecinos[a:b]].tolist(), self.longitudes[a:b].tolist(),
+                               self.pesos[a:b].tolist()))
+            self.cache_vecinos[nodo] = vecinos
+        return vecinos
+
+    def posicion_arista(self, u, v):
+        # Posición de la arista u -> v en los arrays CSR, o None si no son adyacentes
+        a, b = self.tramo(u)
+        j = self.indice.get(v)
+        if j is None:
+            return None
+        encontrados = np.flatnonzero(self.vecinos[a:b] == j)
+        return int(a + encontrados[0]) if len(encontrados) else None
+
+    def peso(self, u, v):
+        posicion = self.posicion_arista(u, v)
+        return None if posicion is None else float(self.pesos[posicion])
+
+    def longitud(self, u, v):
+        posicion = self.posicion_arista(u, v)
+        return None if posicion is None else float(self.longitudes[posicion])
+
+    def has_edge(self, u, v):
+        return u in self.indice and self.posicion_arista(u, v) is not None
+
+    def datos_arista(self, posicion):
+        return {'weight': float(self.pesos[posicion]), 'longitud': float(self.longitudes[posicion]),
+                'es_dog_park': bool(self.es_dog_park[posicion]),
+                'distancia_zona_verde': float(self.distancia_zona_verde[posicion])}
+
+    def __getitem__(self, nodo):
+        a, b = self.tramo(nodo)
+        return {self.osmid[self.vecinos[k]].item(): self.datos_arista(k) for k in range(a, b)}
+
+    def edges(self, data=False):
+        # Cada arista no dirigida una sola vez; los datos son copias (el grafo es de solo lectura)
+        origen = np.repeat(np.arange(len(self.osmid)), np.diff(self.inicio_vecinos))
+        for k in np.flatnonzero(origen <= self.vecinos).tolist():
+            u, v = self.osmid[origen[k]].item(), self.osmid[self.vecinos[k]].item()
+            yield (u, v, self.datos_arista(k)) if data else (u, v)
+
+    def copy(self):
+        return GrafoCompacto(self.osmid.copy(), self.x.copy(), self.y.copy(), self.inicio_vecinos.copy(),
+                             self.vecinos.copy(), self.pesos.copy(), self.es_dog_park.copy(),
+                             self.distancia_zona_verde.copy(), self.graph, self.longitudes.copy(),
+                             None if self.coordenadas_proyectadas is None else self.coordenadas_proyectadas.copy())
+
+    def a_networkx(self):
+        # Conversión para las funciones que necesitan networkx u osmnx
+        import networkx as nx
+        G = nx.Graph()
+        G.add_nodes_from(self.nodes(data=True))
+        G.add_edges_from(self.edges(data=True))
+        G.graph.update({clave: valor for clave, valor in self.graph.items() if clave in ('crs', 'version')})
+        return G
+
+def arrays_csr(G, valores_aristas=()):
+    # Adyacencia CSR de un nx.Graph en el mismo orden de vecinos que G.adj (cada arista en ambos sentidos,
+    # los lazos una vez). valores_aristas son arrays alineados con G.edges() y se devuelven reordenados
+    osmid = np.array(list(G.nodes))
+    indice = {nodo: i for i, nodo in enumerate(G.nodes)}
+    x = np.array([data['x'] for _, data in G.nodes(data=True)], dtype=np.float64)
+    y = np.array([data['y'] for _, data in G.nodes(data=True)], dtype=np.float64)
+    posicion_arista = {}
+    for k, (u, v) in enumerate(G.edges()):
+        posicion_arista[(u, v)] = posicion_arista[(v, u)] = k
+    inicio_vecinos = np.zeros(len(osmid) + 1, dtype=np.int64)
+    np.cumsum([len(G.adj[nodo]) for nodo in G.nodes], out=inicio_vecinos[1:])
+    vecinos = np.array([indice[v] for _, adyacentes in G.adjacency() for v in adyacentes], dtype=np.int32)
+    aristas = np.array([posicion_arista[(u, v)] for u, adyacentes in G.adjacency() for v in adyacentes], dtype=np.int64)
+    return osmid, x, y, inicio_vecinos, vecinos, [np.asarray(valores)[aristas] for valores in valores_aristas]
+
+def desde_networkx(G):
+    # Construye el grafo compacto a partir de un nx.Graph con atributos x, y en los nodos y weight en las aristas
+    datos = [data for _, _, data in G.edges(data=True)]
+    pesos = np.array([data['weight'] for data in datos], dtype=np.float64)
+    longitudes = np.array([data.get('longitud', data['weight']) for data in datos], dtype=np.float64)
+    es_dog_park = np.array([data.get('es_dog_park', False) for data in datos], dtype=bool)
+    distancia_zona_verde = np.array([data.get('distancia_zona_verde', np.inf) for data in datos], dtype=np.float64)
+    osmid, x, y, inicio_vecinos, vecinos, (pesos, longitudes, es_dog_park, distancia_zona_verde) = arrays_csr(
+        G, (pesos, longitudes, es_dog_park, distancia_zona_verde))
+    graph = {clave: valor for clave, valor in G.graph.items() if clave in ('crs', 'version')}
+    return GrafoCompacto(osmid, x, y, inicio_vecinos, vecinos, pesos, es_dog_park, distancia_zona_verde, graph,
+                         longitudes)
+
+def desde_compilado(artefacto):
+    # Usa directamente los arrays (mapeados en memoria) del artefacto de grafo_compilado
+    return GrafoCompacto(artefacto['osmid'], artefacto['x'], artefacto['y'], artefacto['inicio_vecinos'],
+                         artefacto['vecinos'], artefacto['pesos'], artefacto['es_dog_park'],
+                         artefacto['distancia_zona_verde'],
+                         {'crs': artefacto['meta']['crs'], 'version': artefacto['meta']['hash_fuentes'],
+                          'origen_proyeccion': artefacto['meta']['origen_proyeccion']},
+                         artefacto['longitudes'], artefacto['coordenadas_proyectadas'])
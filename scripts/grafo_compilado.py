@@ -0,0 +1,255 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import carga_datos_yDevolver_json as carga_datos
+import distancias as dist
+import grafo_compacto
+import nodos_rutas_y_pesos as nrp
+
+VERSION_FORMATO = 6
+ARRAYS = ('osmid', 'x', 'y', 'coordenadas_proyectadas', 'inicio_vecinos', 'vecinos', 'longitudes', 'pesos',
+          'distancia_zona_verde', 'es_dog_park')
+PERIODO_GRACIA = 60  # Segundos que se conserva una versión sustituida por si algún proceso la está cargando
+
+# Memoria del proceso: hashes de las fuentes por firma (ruta, mtime, tamaño) de los archivos y último artefacto
+# cargado de cada directorio, para no releer ni volver a calcular el hash de las fuentes en cada petición
+hashes_por_firma = {}
+artefactos_cargados = {}
+
+def calcular_hash_archivos(archivos):
+    # Hash del contenido de los archivos de origen
+    h = hashlib.sha256()
+    for archivo in archivos:
+        with open(archivo, 'rb') as f:
+            for bloque in iter(lambda: f.read(1 << 20), b''):
+                h.update(bloque)
+    return h.hexdigest()
+
+def firma_archivos(archivos):
+    # Cambia cuando se modifica o se sustituye alguno de los archivos
+    firma = []
+    for archivo in archivos:
+        estado = os.stat(archivo)
+        firma.append((os.path.abspath(archivo), estado.st_mtime_ns, estado.st_size))
+    return tuple(firma)
+
+def calcular_hashes(archivos, parametros):
+    # Hash de las calles, de las zonas verdes y hash global (fuentes, parámetros de ponderación y formato).
+    # El global es la versión del grafo que usan las cachés de rutas
+    hashes = {'hash_calles': calcular_hash_archivos(archivos[:2]), 'hash_zonas_verdes': calcular_hash_archivos(archivos[2:])}
+    h = hashlib.sha256()
+    h.update(hashes['hash_calles'].encode())
+    h.update(hashes['hash_zonas_verdes'].encode())
+    h.update(json.dumps({clave: float(valor) for clave, valor in parametros.items()}, sort_keys=True).encode())
+    h.update(str(VERSION_FORMATO).encode())
+    hashes['hash_fuentes'] = h.hexdigest()
+    return hashes
+
+def origen_proyeccion(x, y):
+    # Centro de la región: origen de las coordenadas en metros del índice espacial de nodos
+    return [float(y.mean()), float(x.mean())] if len(x) else [0.0, 0.0]
+
+def grafo_a_arrays(G):
+    # Coordenadas de nodos (también proyectadas a metros para el KD-tree) y adyacencia CSR en el orden de
+    # vecinos de networkx, con la capa de zonas verdes
+    datos = [data for _, _, data in G.edges(data=True)]
+    valores = (np.array([data.get('longitud', data['weight']) for data in datos], dtype=np.float64),
+               np.array([data['weight'] for data in datos], dtype=np.float64),
+               np.array([data.get('distancia_zona_verde', np.inf) for data in datos], dtype=np.float64),
+               np.array([data.get('es_dog_park', False) for data in datos], dtype=bool))
+    osmid, x, y, inicio_vecinos, vecinos, (longitudes, pesos, distancias, es_dog_park) = grafo_compacto.arrays_csr(G, valores)
+    arrays = {
+        'osmid': osmid.astype(np.int64),
+        'x': x,
+        'y': y,
+        'coordenadas_proyectadas': dist.proyectar_equirectangular(y, x, *origen_proyeccion(x, y)),
+        'inicio_vecinos': inicio_vecinos,
+        'vecinos': vecinos,
+        'longitudes': longitudes,
+        'pesos': pesos,
+        'distancia_zona_verde': distancias,
+        'es_dog_park': es_dog_park,
+    }
+    return arrays
+
+def escribir_artefacto(directorio, arrays, meta):
+    # Cada compilación escribe su propia versión (<directorio>.v-<id>) y directorio pasa a ser un enlace
+    # simbólico a ella. El enlace se sustituye con os.replace, así que los lectores siempre encuentran una
+    # versión completa y dos procesos que compilan a la vez no se pisan los archivos
+    base = directorio.rstrip(os.sep)
+    version = f"{base}.v-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(version)
+    for nombre in ARRAYS:
+        np.save(os.path.join(version, nombre + '.npy'), arrays[nombre])
+    with open(os.path.join(version, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    if os.path.isdir(base) and not os.path.islink(base):
+        # Artefacto de antes de las versiones: se aparta una sola vez
+        os.replace(base, f"{base}.v-antiguo-{uuid.uuid4().hex[:8]}")
+    enlace = f"{base}.enlace-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    os.symlink(os.path.basename(version), enlace)
+    os.replace(enlace, base)
+    borrar_versiones_antiguas(base)
+
+def borrar_versiones_antiguas(base):
+    # Borra las versiones que ya no son la actual y llevan más de PERIODO_GRACIA segundos sin tocarse
+    # (las más recientes pueden estar cargándose o ser la compilación en curso de otro proceso)
+    carpeta, nombre = os.path.split(os.path.abspath(base))
+    actual = os.path.realpath(base)
+    limite = time.time() - PERIODO_GRACIA
+    for entrada in os.listdir(carpeta):
+        ruta = os.path.join(carpeta, entrada)
+        if not entrada.startswith(nombre + '.v-') or ruta == actual:
+            continue
+        try:
+            if os.path.getmtime(ruta) < limite:
+                shutil.rmtree(ruta, ignore_errors=True)
+        except OSError:
+            pass
+
+def compilar_grafo(directorio, nombre_archivo_nodos, nombre_archivo_aristas, nombre_archivo_zonas_verdes,
+                   distancia_umbral=10, factor_reduccion=0.5, factor_reduccion_dog_park=0.7):
+    parametros = {'distancia_umbral': distancia_umbral, 'factor_reduccion': factor_reduccion,
+                  'factor_reduccion_dog_park': factor_reduccion_dog_park}
+    archivos = [nombre_archivo_nodos, nombre_archivo_aristas, nombre_archivo_zonas_verdes]
+
+    # Construir el grafo ponderado final a partir de los GeoJSON
+    nodos_gdf, aristas_gdf = carga_datos.cargar_datos_geojson(nombre_archivo_nodos, nombre_archivo_aristas)
+    G = nrp.crear_grafo_desde_geojson(nodos_gdf, aristas_gdf)
+    zonas_verdes_gdf = carga_datos.zonas_verdes_gdf(nombre_archivo_zonas_verdes)
+    nrp.aplicar_peso_zonas_verdes_en_bloque(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park)
+
+    arrays = grafo_a_arrays(G)
+
+    meta = {
+        'version_formato': VERSION_FORMATO,
+        **calcular_hashes(archivos, parametros),
+        'archivos_fuente': [os.path.basename(archivo) for archivo in archivos],
+        'parametros': parametros,
+        # Caja de la región (lon_min, lat_min, lon_max, lat_max) para localizarla sin cargar los arrays
+        'limites': [float(arrays['x'].min()), float(arrays['y'].min()), float(arrays['x'].max()), float(arrays['y'].max())],
+        'origen_proyeccion': origen_proyeccion(arrays['x'], arrays['y']),
+        'crs': G.graph.get('crs', 'epsg:4326'),
+        'num_nodos': len(arrays['osmid']),
+        'num_aristas': G.number_of_edges(),
+        'aristas_actualizadas': G.number_of_edges(),
+    }
+    escribir_artefacto(directorio, arrays, meta)
+    return meta
+
+def reponderar_grafo_compilado(directorio, nombre_archivo_zonas_verdes, parametros, hashes, recalcular_zonas_verdes):
+    # Rehace solo la capa de pesos de un artefacto cuyas calles no han cambiado. Con los mismos parques basta
+    # reaplicar los factores sobre las distancias guardadas; si cambiaron los parques se recalculan las
+    # distancias de las aristas en bloque, sin volver a construir el grafo desde los GeoJSON
+    artefacto = cargar_grafo_compilado(directorio, mmap=False)
+    meta = artefacto['meta']
+    G = grafo_compacto.desde_compilado(artefacto)
+    anteriores = artefacto['pesos']
+    zonas_verdes_gdf = carga_datos.zonas_verdes_gdf(nombre_archivo_zonas_verdes)
+    capa = nrp.CapaZonasVerdes(G, zonas_verdes_gdf, **meta['parametros'], recalcular=recalcular_zonas_verdes)
+    capa.cambiar_factores(**parametros)
+
+    artefacto.update({'pesos': G.pesos, 'distancia_zona_verde': G.distancia_zona_verde, 'es_dog_park': G.es_dog_park})
+    meta.update(hashes)
+    meta['parametros'] = parametros
+    # Aristas no dirigidas cuyo peso cambió respecto al artefacto anterior
+    origen = np.repeat(np.arange(len(G)), np.diff(G.inicio_vecinos))
+    meta['aristas_actualizadas'] = int(np.count_nonzero((G.pesos != anteriores) & (origen <= G.vecinos)))
+    escribir_artefacto(directorio, artefacto, meta)
+    return meta
+
+def leer_meta(directorio):
+    try:
+        with open(os.path.join(directorio, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def estado_artefacto(meta, hashes):
+    # 'actualizado', 'pesos' (mismas calles: basta rehacer la capa de pesos) u 'obsoleto'
+    if meta is None or meta.get('version_formato') != VERSION_FORMATO:
+        return 'obsoleto'
+    if meta['hash_fuentes'] == hashes['hash_fuentes']:
+        return 'actualizado'
+    if meta['hash_calles'] == hashes['hash_calles']:
+        return 'pesos'
+    return 'obsoleto'
+
+def hashes_fuentes(archivos, parametros):
+    # calcular_hashes, pero solo se vuelven a leer las fuentes si cambió su firma
+    clave = (firma_archivos(archivos), tuple(sorted(parametros.items())))
+    hashes = hashes_por_firma.get(clave)
+    if hashes is None:
+        hashes = calcular_hashes(archivos, parametros)
+        hashes_por_firma[clave] = hashes
+    return hashes
+
+def artefacto_actualizado(directorio, archivos, parametros):
+    # Un artefacto está obsoleto si falta o si cambió el contenido de sus fuentes o los parámetros
+    return estado_artefacto(leer_meta(directorio), calcular_hashes(archivos, parametros)) == 'actualizado'
+
+def cargar_grafo_compilado(directorio, mmap=True):
+    # Los arrays se mapean en memoria: varios procesos comparten las mismas páginas. El enlace se resuelve
+    # una vez para leer meta y arrays de la misma versión aunque otro proceso la sustituya mientras tanto
+    version = os.path.realpath(directorio)
+    meta = leer_meta(version)
+    if meta is None:
+        raise FileNotFoundError(f"No hay un grafo compilado en {directorio}")
+    artefacto = {'meta': meta}
+    for nombre in ARRAYS:
+        artefacto[nombre] = np.load(os.path.join(version, nombre + '.npy'), mmap_mode='r' if mmap else None)
+    return artefacto
+
+def obtener_grafo_compilado(directorio, nombre_archivo_nodos, nombre_archivo_aristas, nombre_archivo_zonas_verdes,
+                            distancia_umbral=10, factor_reduccion=0.5, factor_reduccion_dog_park=0.7):
+    # Carga el artefacto y lo recompila antes si sus fuentes han cambiado
+    parametros = {'distancia_umbral': distancia_umbral, 'factor_reduccion': factor_reduccion,
+                  'factor_reduccion_dog_park': factor_reduccion_dog_park}
+    archivos = [nombre_archivo_nodos, nombre_archivo_aristas, nombre_archivo_zonas_verdes]
+    hashes = hashes_fuentes(archivos, parametros)
+    # Mientras el enlace apunte a la misma versión y las fuentes no cambien se reutiliza el artefacto ya
+    # cargado; si otro proceso lo recompila, el enlace apunta a otra versión y se vuelve a cargar
+    cargado = artefactos_cargados.get(os.path.abspath(directorio))
+    if (cargado is not None and cargado[0] == os.path.realpath(directorio)
+            and cargado[1]['meta']['hash_fuentes'] == hashes['hash_fuentes']):
+        return cargado[1]
+    meta = leer_meta(directorio)
+    estado = estado_artefacto(meta, hashes)
+    if estado == 'pesos':
+        reponderar_grafo_compilado(directorio, nombre_archivo_zonas_verdes, parametros, hashes,
+                                   meta['hash_zonas_verdes'] != hashes['hash_zonas_verdes'])
+    elif estado == 'obsoleto':
+        compilar_grafo(directorio, *archivos, **parametros)
+    # La versión se resuelve antes de cargar: si cambia entre medias, la siguiente llamada vuelve a cargar
+    version = os.path.realpath(directorio)
+    artefacto = cargar_grafo_compilado(directorio)
+    artefactos_cargados[os.path.abspath(directorio)] = (version, artefacto)
+    return artefacto
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compila el grafo ponderado de paseo a un artefacto binario")
+    parser.add_argument('directorio', nargs='?', default='grafo_burgos')
+    parser.add_argument('--nodos', default='nodos_burgos.geojson')
+    parser.add_argument('--aristas', default='aristas_burgos.geojson')
+    parser.add_argument('--zonas-verdes', default='parques.geojson')
+    parser.add_argument('--distancia-umbral', type=float, default=10)
+    parser.add_argument('--factor-reduccion', type=float, default=0.5)
+    parser.add_argument('--factor-reduccion-dog-park', type=float, default=0.7)
+    parser.add_argument('--forzar', action='store_true', help="Compilar desde cero aunque el artefacto esté al día")
+    args = parser.parse_args()
+    archivos = [args.nodos, args.aristas, args.zonas_verdes]
+    parametros = {'distancia_umbral': args.distancia_umbral, 'factor_reduccion': args.factor_reduccion,
+                  'factor_reduccion_dog_park': args.factor_reduccion_dog_park}
+    if not args.forzar and artefacto_actualizado(args.directorio, archivos, parametros):
+        print(f"El grafo compilado en {args.directorio} está al día")
+    else:
+        meta = (compilar_grafo(args.directorio, *archivos, **parametros) if args.forzar
+                else obtener_grafo_compilado(args.directorio, *archivos, **parametros)['meta'])
+        print(f"Grafo compilado en {args.directorio}: {meta['num_nodos']} nodos, {meta['num_aristas']} aristas, "
+              f"{meta['aristas_actualizadas']} aristas actualizadas")
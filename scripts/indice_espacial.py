@@ -0,0 +1,194 @@
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+import distancias as dist
+
+class IndiceEspacialNodos:
+    # KD-tree sobre las coordenadas de los nodos proyectadas a metros (equirectangular local). Con un grafo
+    # del artefacto compilado las coordenadas proyectadas ya vienen mapeadas en memoria y solo se monta el árbol
+    def __init__(self, G):
+        indice, lat, lon = dist.coordenadas_nodos(G)
+        proyectadas = getattr(G, 'coordenadas_proyectadas', None)
+        if proyectadas is not None:
+            self.nodos = G.osmid.astype(object)
+            self.lat_origen, self.lon_origen = G.graph['origen_proyeccion']
+        else:
+            self.nodos = np.array(list(indice), dtype=object)
+            self.lat_origen = float(lat.mean()) if len(lat) else 0.0
+            self.lon_origen = float(lon.mean()) if len(lon) else 0.0
+            proyectadas = self.proyectar(lat, lon)
+        self.num_nodos = len(self.nodos)
+        self.coordenadas = proyectadas
+        self.arbol = cKDTree(proyectadas) if len(lat) else None
+
+    def proyectar(self, lat, lon):
+        return dist.proyectar_equirectangular(lat, lon, self.lat_origen, self.lon_origen)
+
+    def ajustar(self, lat, lon):
+        # Nodo más cercano y distancia en metros para uno o muchos puntos a la vez
+        distancias, posiciones = self.arbol.query(self.proyectar(lat, lon))
+        return self.nodos[posiciones], distancias
+
+    def candidatos(self, lat, lon, radio, max_candidatos):
+        # Hasta max_candidatos nodos a menos de radio metros de un punto, del más cercano al más lejano
+        distancias, posiciones = self.arbol.query(self.proyectar(lat, lon)[0], k=min(max_candidatos, self.num_nodos),
+                                                  distance_upper_bound=radio)
+        distancias, posiciones = np.atleast_1d(distancias), np.atleast_1d(posiciones)
+        validos = np.isfinite(distancias)
+        return self.nodos[posiciones[validos]].tolist(), distancias[validos]
+
+def indice_espacial(G):
+    # Índice construido una vez por grafo y guardado en sus atributos
+    indice = G.graph.get('indice_espacial')
+    if indice is None or indice.num_nodos != G.number_of_nodes():
+        indice = IndiceEspacialNodos(G)
+        G.graph['indice_espacial'] = indice
+    return indice
+
+class EmparejadorTrazas:
+    # Map matching en streaming (HMM + Viterbi con retardo fijo): solo guarda los últimos `ventana` puntos
+    def __init__(self, G, radio_busqueda=50, max_candidatos=5, sigma=10, beta=30, ventana=20):
+        self.G = G
+        self.indice = indice_espacial(G)
+        self.radio_busqueda = radio_busqueda
+        self.max_candidatos = max_candidatos
+        self.sigma = sigma
+        self.beta = beta
+        self.ventana = ventana
+        # Longitud geométrica de las aristas (sin las reducciones por zonas verdes) para comparar con el GPS
+        self.longitudes = dist.matriz_longitudes(G)
+        self.posiciones, _, _ = dist.coordenadas_nodos(G)
+        # Ningún camino por la red es más corto que factor_cota por la distancia en línea recta
+        self.factor_cota = dist.factor_cota_inferior(G)
+        # Cada paso: (lat, lon, candidatos, log-probabilidades, índice del mejor predecesor de cada candidato)
+        self.pasos = []
+        self.ultimo_emitido = None
+
+    def añadir_punto(self, lat, lon):
+        # Incorpora un punto de la traza y devuelve los nodos del camino que ya quedan fijados
+        candidatos, distancias = self.indice.candidatos(lat, lon, self.radio_busqueda, self.max_candidatos)
+        if not candidatos:
+            return []
+        emision = -0.5 * (distancias / self.sigma) ** 2
+
+        if not self.pasos:
+            self.pasos.append((lat, lon, candidatos, emision, np.full(len(candidatos), -1)))
+            return []
+
+        lat_prev, lon_prev, candidatos_prev, log_prev, _ = self.pasos[-1]
+        recta = dist.haversine_escalar(lat_prev, lon_prev, lat, lon)
+        transicion = self.transiciones(candidatos_prev, candidatos, recta)
+        totales = log_prev[:, None] + transicion
+        mejores_prev = np.argmax(totales, axis=0)
+        log_actual = totales[mejores_prev, np.arange(len(candidatos))] + emision
+
+        emitidos = []
+        if not np.isfinite(log_actual).any():
+            # Ningún candidato es alcanzable desde el paso anterior: se cierra el tramo y se empieza otro
+            emitidos = self.vaciar()
+            self.pasos.append((lat, lon, candidatos, emision, np.full(len(candidatos), -1)))
+            return emitidos
+
+        self.pasos.append((lat, lon, candidatos, log_actual - log_actual.max(), mejores_prev))
+        while len(self.pasos) > self.ventana:
+            emitidos.extend(self.fijar_primero())
+        return emitidos
+
+    def subgrafo_local(self, origenes, limite):
+        # Posiciones (ordenadas) de los nodos a los que se puede llegar desde los orígenes sin pasar de `limite`
+        # metros por la red y matriz de longitudes entre ellos. Un camino de `limite` metros no se aleja más de
+        # limite / factor_cota en línea recta, así que basta buscarlos con el KD-tree en ese radio (con un
+        # margen por la proyección equirectangular). Dijkstra sobre esta submatriz da las mismas distancias
+        # que sobre todo el grafo con el mismo límite
+        if self.factor_cota <= 0:
+            return np.arange(self.longitudes.shape[0]), self.longitudes
+        radio = limite / self.factor_cota * 1.01 + 1
+        cercanos = self.indice.arbol.query_ball_point(self.indice.coordenadas[origenes], radio, return_sorted=False)
+        locales = np.unique(np.concatenate([np.asarray(origenes, dtype=np.int64)] +
+                                           [np.asarray(c, dtype=np.int64) for c in cercanos]))
+        return locales, self.longitudes[locales][:, locales]
+
+    def transiciones(self, candidatos_prev, candidatos, recta):
+        # Penaliza la diferencia entre la distancia por la red y la distancia en línea recta entre puntos GPS
+        limite = recta + 2 * self.radio_busqueda
+        origenes = [self.posiciones[nodo] for nodo in candidatos_prev]
+        destinos = np.array([self.posiciones[nodo] for nodo in candidatos], dtype=np.int64)
+        locales, longitudes = self.subgrafo_local(origenes, limite)
+        # Los destinos fuera del subgrafo quedan a más de `limite`: inalcanzables
+        destinos_locales = np.minimum(np.searchsorted(locales, destinos), len(locales) - 1)
+        dentro = locales[destinos_locales] == destinos
+        por_red = np.full((len(origenes), len(destinos)), np.inf)
+        por_red[:, dentro] = dijkstra(longitudes, directed=False, indices=np.searchsorted(locales, origenes),
+                                      limit=limite)[:, destinos_locales[dentro]]
+        return np.where(np.isfinite(por_red), -np.abs(por_red - recta) / self.beta, -np.inf)
+
+    def mejor_camino(self):
+        # Candidato elegido en cada paso de la ventana según Viterbi
+        actual = int(np.argmax(self.pasos[-1][3]))
+        elegidos = [actual]
+        for paso in reversed(self.pasos[1:]):
+            actual = int(paso[4][actual])
+            elegidos.append(actual)
+        elegidos.reverse()
+        return [paso[2][i] for paso, i in zip(self.pasos, elegidos)]
+
+    def fijar_primero(self):
+        # Fija el paso más antiguo de la ventana según el mejor camino actual y lo elimina; el nuevo
+        # primer paso conserva sus probabilidades acumuladas pero ya no tiene predecesores
+        nodo = self.mejor_camino()[0]
+        self.pasos.pop(0)
+        lat, lon, candidatos, log_prob, _ = self.pasos[0]
+        self.pasos[0] = (lat, lon, candidatos, log_prob, np.full(len(candidatos), -1))
+        return self.emitir(nodo)
+
+    def vaciar(self):
+        # Fija todos los pasos de la ventana
+        emitidos = []
+        if self.pasos:
+            for nodo in self.mejor_camino():
+                emitidos.extend(self.emitir(nodo))
+        self.pasos = []
+        return emitidos
+
+    def emitir(self, nodo):
+        # Devuelve el tramo de red desde el último nodo emitido hasta `nodo`
+        if self.ultimo_emitido is None:
+            self.ultimo_emitido = nodo
+            return [nodo]
+        if nodo == self.ultimo_emitido:
+            return []
+        # Los nodos emitidos consecutivos están cerca: basta un Dijkstra limitado sobre el subgrafo local
+        origen, destino = self.posiciones[self.ultimo_emitido], self.posiciones[nodo]
+        limite = 4 * dist.distancia_entre_nodos(self.G, self.ultimo_emitido, nodo, usar_aristas=False) + 2 * self.radio_busqueda
+        locales, longitudes = self.subgrafo_local([origen], limite)
+        destino_local = int(np.searchsorted(locales, destino))
+        camino = [nodo]
+        if destino_local < len(locales) and locales[destino_local] == destino:
+            _, predecesores = dijkstra(longitudes, directed=False, indices=int(np.searchsorted(locales, origen)),
+                                       limit=limite, return_predecessors=True)
+            if predecesores[destino_local] >= 0:
+                camino = [self.indice.nodos[locales[k]] for k in dist.reconstruir_camino(predecesores, destino_local)[1:]]
+        self.ultimo_emitido = nodo
+        return camino
+
+    def finalizar(self):
+        return self.vaciar()
+
+def emparejar_traza(G, puntos, **parametros):
+    # Empareja una traza completa de puntos (lat, lon) y devuelve la ruta de nodos
+    emparejador = EmparejadorTrazas(G, **parametros)
+    ruta = []
+    for lat, lon in puntos:
+        ruta.extend(emparejador.añadir_punto(lat, lon))
+    ruta.extend(emparejador.finalizar())
+    return ruta
+
+def comparar_con_ruta(ruta_planificada, ruta_emparejada):
+    # Fracción de tramos de la ruta planificada que se recorrieron y de tramos recorridos que estaban planificados
+    tramos_plan = {frozenset(par) for par in zip(ruta_planificada, ruta_planificada[1:]) if par[0] != par[1]}
+    tramos_reales = {frozenset(par) for par in zip(ruta_emparejada, ruta_emparejada[1:]) if par[0] != par[1]}
+    comunes = len(tramos_plan & tramos_reales)
+    return {
+        'cobertura_plan': comunes / len(tramos_plan) if tramos_plan else 0.0,
+        'precision': comunes / len(tramos_reales) if tramos_reales else 0.0,
+    }
@@ -0,0 +1,182 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Configuración del proceso. Desactivada por defecto: etapa() y contar() solo consultan la traza actual.
+# modo: None, 'respuesta' (la traza se añade al JSON de respuesta) o 'registro' (una línea JSON por petición
+# en destino, que puede ser una ruta de archivo, '-' para stderr o una función)
+configuracion = {'modo': None, 'destino': None, 'perfilar': False, 'intervalo_muestreo': 0.005, 'perfilador': None}
+traza_actual = contextvars.ContextVar('traza_actual', default=None)
+lock_registro = threading.Lock()
+
+def configurar(modo=None, destino=None, perfilar=False, intervalo_muestreo=0.005, perfilador=None):
+    # perfilador: función (id de hilo, intervalo) que devuelve un objeto con detener(); por defecto MuestreadorPila
+    configuracion.update({'modo': modo, 'destino': destino, 'perfilar': perfilar,
+                          'intervalo_muestreo': intervalo_muestreo, 'perfilador': perfilador})
+
+def configurar_desde_entorno():
+    # PASEADOR_TRAZA=respuesta o PASEADOR_TRAZA=<archivo>|-  y  PASEADOR_PERFIL=1 para el muestreo de pilas.
+    # Los procesos worker heredan estas variables
+    valor = os.environ.get('PASEADOR_TRAZA')
+    perfilar = os.environ.get('PASEADOR_PERFIL') == '1'
+    if valor == 'respuesta':
+        configurar('respuesta', perfilar=perfilar)
+    elif valor:
+        configurar('registro', valor, perfilar=perfilar)
+
+def configuracion_serializable():
+    # Para pasarla al inicializador de los procesos worker (sin funciones, que no siempre se pueden serializar)
+    return {clave: valor for clave, valor in configuracion.items() if not callable(valor)}
+
+class MuestreadorPila:
+    # Perfilador por muestreo: un hilo aparte lee cada `intervalo` segundos la pila del hilo que atiende la
+    # petición y cuenta las pilas vistas (formato de pilas plegadas, apto para flame graphs)
+    def __init__(self, id_hilo, intervalo):
+        self.id_hilo = id_hilo
+        self.intervalo = intervalo
+        self.muestras = Counter()
+        self.parar = threading.Event()
+        self.hilo = threading.Thread(target=self.muestrear, daemon=True)
+        self.hilo.start()
+
+    def muestrear(self):
+        while not self.parar.wait(self.intervalo):
+            marco = sys._current_frames().get(self.id_hilo)
+            pila = []
+            while marco is not None and len(pila) < 40:
+                codigo = marco.f_code
+                pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{marco.f_lineno})")
+                marco = marco.f_back
+            if pila:
+                self.muestras[';'.join(reversed(pila))] += 1
+
+    def detener(self, maximo=20):
+        self.parar.set()
+        self.hilo.join()
+        return [{'pila': pila, 'muestras': n} for pila, n in self.muestras.most_common(maximo)]
+
+class Traza:
+    # Tiempos por etapa y contadores de una petición
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.inicio = time.perf_counter()
+        self.etapas = {}
+        self.contadores = Counter()
+        self.perfilador = None
+        self.token = None
+        if configuracion['perfilar']:
+            fabrica = configuracion['perfilador'] or MuestreadorPila
+            self.perfilador = fabrica(threading.get_ident(), configuracion['intervalo_muestreo'])
+
+    def sumar_etapa(self, nombre, segundos):
+        etapa = self.etapas.get(nombre)
+        if etapa is None:
+            self.etapas[nombre] = {'segundos': segundos, 'llamadas': 1}
+        else:
+            etapa['segundos'] += segundos
+            etapa['llamadas'] += 1
+
+    def a_dict(self):
+        datos = {
+            'nombre': self.nombre,
+            'pid': os.getpid(),
+            'total': time.perf_counter() - self.inicio,
+            'etapas': self.etapas,
+            'contadores': dict(self.contadores),
+        }
+        if self.perfilador is not None:
+            datos['perfil'] = self.perfilador.detener()
+        return datos
+
+class Etapa:
+    __slots__ = ('traza', 'nombre', 'inicio')
+
+    def __init__(self, traza, nombre):
+        self.traza = traza
+        self.nombre = nombre
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *excepcion):
+        self.traza.sumar_etapa(self.nombre, time.perf_counter() - self.inicio)
+        return False
+
+class EtapaVacia:
+    # Lo que devuelve etapa() sin traza activa: no mide nada
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        return False
+
+ETAPA_VACIA = EtapaVacia()
+
+def etapa(nombre):
+    traza = traza_actual.get()
+    return ETAPA_VACIA if traza is None else Etapa(traza, nombre)
+
+def contar(nombre, cantidad=1):
+    traza = traza_actual.get()
+    if traza is not None:
+        traza.contadores[nombre] += cantidad
+
+def incorporar(datos):
+    # Suma a la traza actual las etapas y contadores de una traza de otro proceso (p. ej. un worker)
+    traza = traza_actual.get()
+    if traza is None or not datos:
+        return
+    for nombre, etapa in datos['etapas'].items():
+        traza.sumar_etapa(nombre, etapa['segundos'])
+        traza.etapas[nombre]['llamadas'] += etapa['llamadas'] - 1
+    traza.contadores.update(datos['contadores'])
+
+def iniciar_traza(nombre):
+    # Devuelve None (y no cuesta nada más) si la instrumentación está desactivada
+    if configuracion['modo'] is None:
+        return None
+    traza = Traza(nombre)
+    traza.token = traza_actual.set(traza)
+    return traza
+
+def escribir_registro(datos):
+    destino = configuracion['destino']
+    if callable(destino):
+        destino(datos)
+        return
+    linea = json.dumps(datos, ensure_ascii=False) + '\n'
+    with lock_registro:
+        if destino in (None, '-'):
+            sys.stderr.write(linea)
+        else:
+            # Una sola escritura en modo append: las líneas de varios procesos no se mezclan
+            with open(destino, 'a', encoding='utf-8') as f:
+                f.write(linea)
+
+def finalizar_traza(traza):
+    # En modo 'respuesta' devuelve la traza para añadirla a la respuesta; en modo 'registro' la escribe
+    if traza is None:
+        return None
+    traza_actual.reset(traza.token)
+    datos = traza.a_dict()
+    if configuracion['modo'] == 'registro':
+        escribir_registro(datos)
+        return None
+    return datos
+
+def extraer_traza(traza):
+    # Como finalizar_traza pero sin escribirla: devuelve los datos para que los incorpore (ver incorporar) la
+    # traza de la petición en otro proceso
+    if traza is None:
+        return None
+    traza_actual.reset(traza.token)
+    return traza.a_dict()
+
+configurar_desde_entorno()
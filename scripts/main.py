@@ -1,10 +1,44 @@
+import os
 import carga_datos_yDevolver_json as carga_datos
-import geopandas as gpd
-import nodos_rutas_y_pesos as nrp
-import geopandas as gpd
+import cache_rutas
+import grafo_compilado as gc
+import grafo_compacto
+import instrumentacion as instr
+import salida_rutas
+
+# Grafo y zonas verdes ya cargados en este proceso: las llamadas siguientes a main los reutilizan mientras
+# no cambien el artefacto ni el archivo de zonas verdes
+recursos_cargados = {}
+
+def cargar_recursos(directorio_grafo='grafo_burgos', nombre_archivo_nodos='nodos_burgos.geojson',
+                    nombre_archivo_aristas='aristas_burgos.geojson', nombre_archivo_zonas_verdes='parques.geojson'):
+    # Cargar el grafo ponderado precompilado (se recompila solo si cambian las fuentes)
+    factor_reduccion_general = 0.5
+    factor_reduccion_dog_park = 0.7  # Mayor reducción para dog parks
+    clave = (os.path.abspath(directorio_grafo), os.path.abspath(nombre_archivo_zonas_verdes))
+    cargados = recursos_cargados.get(clave)
+    with instr.etapa('cargar_grafo'):
+        artefacto = gc.obtener_grafo_compilado(directorio_grafo, nombre_archivo_nodos, nombre_archivo_aristas,
+                                               nombre_archivo_zonas_verdes, distancia_umbral=10,
+                                               factor_reduccion=factor_reduccion_general,
+                                               factor_reduccion_dog_park=factor_reduccion_dog_park)
+        if cargados is not None and cargados[0] is artefacto:
+            G = cargados[1]
+        else:
+            G = grafo_compacto.desde_compilado(artefacto)
+
+    # Cargar zonas verdes
+    with instr.etapa('cargar_zonas_verdes'):
+        firma = gc.firma_archivos([nombre_archivo_zonas_verdes])
+        if cargados is not None and cargados[2] == firma:
+            zonas_verdes_gdf = cargados[3]
+        else:
+            zonas_verdes_gdf = carga_datos.zonas_verdes_gdf(nombre_archivo_zonas_verdes)
+    recursos_cargados[clave] = (artefacto, G, firma, zonas_verdes_gdf)
+    return G, zonas_verdes_gdf
 
 # Principal
-def main(json_input):
+def main(json_input, mapa=False, estrategia='ciclos', cache=None):
     datos_perro = carga_datos.cargar_datos_perro(json_input)
     if not datos_perro:
         print("No se pudieron cargar los datos del perro.")
@@ -14,31 +48,29 @@ def main(json_input):
     tamaño, edad, raza = datos_perro['tamaño'], datos_perro['edad'], datos_perro['raza']
     duracion_paseo = datos_perro['duracion']
 
-    # Cargar datos geográficos
-    nombre_archivo_nodos = 'nodos_burgos.geojson'
-    nombre_archivo_aristas = 'aristas_burgos.geojson'
-    nodos_gdf, aristas_gdf = carga_datos.cargar_datos_geojson(nombre_archivo_nodos, nombre_archivo_aristas)
-    G = carga_datos.crear_grafo_desde_geojson(nodos_gdf, aristas_gdf)
+    # Traza de tiempos por etapa y contadores (solo si la instrumentación está activada)
+    traza = instr.iniciar_traza('main')
+    try:
+        G, zonas_verdes_gdf = cargar_recursos()
 
-    # Cargar zonas verdes
-    zonas_verdes_gdf = gpd.read_file('parques.geojson')
-    factor_reduccion_general = 0.5
-    factor_reduccion_dog_park = 0.7  # Mayor reducción para dog parks
-    nrp.aplicar_peso_zonas_verdes(G, zonas_verdes_gdf, distancia_umbral=10, 
-                            factor_reduccion=factor_reduccion_general, 
-                            factor_reduccion_dog_park=factor_reduccion_dog_park)
-
-    nodo_mas_cercano = carga_datos.obtener_ubicacion_actual(G, latitud_actual, longitud_actual)
-
-    # Generar y visualizar rutas
-    perfil_perro = {'tamaño': tamaño, 'edad': edad, 'raza': raza}
-    rutas = nrp.generar_rutas(G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf)
-    nombre_archivo_mapa = nrp.visualizar_rutas(G, rutas, latitud_actual, longitud_actual)
-    # nombre_archivo_mapa.save('rutas_paseo.html')
-    respuesta_json = carga_datos.generar_json_respuesta(rutas, nombre_archivo_mapa, json_input)    
+        with instr.etapa('ajustar_inicio'):
+            nodo_mas_cercano = carga_datos.obtener_ubicacion_actual(G, latitud_actual, longitud_actual)
+
+        # Generar la ruta; el mapa HTML solo se dibuja si se pide y en segundo plano
+        perfil_perro = {'tamaño': tamaño, 'edad': edad, 'raza': raza}
+        ruta = cache_rutas.generar_rutas_con_cache(cache, G, nodo_mas_cercano, duracion_paseo, perfil_perro,
+                                                  zonas_verdes_gdf, estrategia)
+        nombre_archivo_mapa = None
+        if mapa:
+            nombre_archivo_mapa, _ = salida_rutas.programar_mapa(G, [ruta], latitud_actual, longitud_actual)
+    except Exception:
+        instr.finalizar_traza(traza)
+        raise
+    respuesta_json = carga_datos.generar_json_respuesta(ruta, nombre_archivo_mapa, json_input, G,
+                                                        instr.finalizar_traza(traza))
     return respuesta_json
 
 if __name__ == "__main__":
     json_input = '{"latitud": 42.3439, "longitud": -3.1007, "tamaño": "mediano", "edad": 5, "raza": "Labrador", "duracion": 30}'
-    respuesta = main(json_input)
+    respuesta = main(json_input, mapa=True)
     print(respuesta)
@@ -1,15 +1,22 @@
-from shapely.geometry import Point, LineString
-import geopandas as gpd
-from geopy.distance import distance
-from shapely.ops import nearest_points
-import networkx as nx
+import numpy as np
 import caracter_perro as cp
 import velocidad_y_distancia as vd
-import carga_datos_yDevolver_json as carga_datos
-import folium
-import osmnx as ox
+import distancias as dist
+import instrumentacion as instr
+import salida_rutas
+import heapq
+import time
+
+# geopandas, shapely y networkx se importan dentro de las funciones que los usan: la búsqueda y la
+# puntuación de rutas sobre el grafo compilado no los necesitan y así el arranque es rápido
+
+# Diferencia relativa que se admite entre la distancia estimada del paseo de un perro y la distancia con la
+# que se generaron las candidatas entre las que seleccionar_ruta elige su ruta (al compartirlas en un lote)
+TOLERANCIA_DISTANCIA = 0.02
 
 def lineas_a_nodos(calles_gdf):
+    from shapely.geometry import Point, LineString
+    import geopandas as gpd
     nodos = set()
     for linea in calles_gdf.geometry:
         if isinstance(linea, LineString):
@@ -41,63 +48,277 @@ def calcular_distancia_y_tipo_zonas_verdes(arista, zonas_verdes_gdf):
             es_dog_park = zona_verde['leisure'] == 'dog_park' or zona_verde['tipo_jardin'] == 'dog_park'
     return distancia_minima, es_dog_park
 
-def aplicar_peso_zonas_verdes(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park):
+def calcular_distancias_y_tipo_zonas_verdes_en_bloque(puntos, zonas_verdes_gdf):
+    import shapely
+    # Versión vectorizada de calcular_distancia_y_tipo_zonas_verdes para un array de puntos
+    distancias = np.full(len(puntos), np.inf)
+    es_dog_park = np.zeros(len(puntos), dtype=bool)
+    if len(puntos) == 0 or zonas_verdes_gdf.empty:
+        return distancias, es_dog_park
+
+    # Una sola consulta al índice espacial: pares (punto, zona verde) cuyas cajas se intersectan
+    indices_puntos, indices_zonas = zonas_verdes_gdf.sindex.query(puntos)
+    if len(indices_puntos) == 0:
+        return distancias, es_dog_park
+    distancias_pares = shapely.distance(puntos[indices_puntos], zonas_verdes_gdf.geometry.values[indices_zonas])
+
+    # Para cada punto, quedarse con la zona verde más cercana (la de menor índice en caso de empate)
+    orden = np.lexsort((indices_zonas, distancias_pares, indices_puntos))
+    indices_puntos, indices_zonas, distancias_pares = indices_puntos[orden], indices_zonas[orden], distancias_pares[orden]
+    primeros = np.flatnonzero(np.r_[True, indices_puntos[1:] != indices_puntos[:-1]])
+
+    columnas_dog_park = np.zeros(len(zonas_verdes_gdf), dtype=bool)
+    for columna in ('leisure', 'tipo_jardin'):
+        if columna in zonas_verdes_gdf:
+            columnas_dog_park |= (zonas_verdes_gdf[columna] == 'dog_park').to_numpy()
+
+    distancias[indices_puntos[primeros]] = distancias_pares[primeros]
+    es_dog_park[indices_puntos[primeros]] = columnas_dog_park[indices_zonas[primeros]]
+    return distancias, es_dog_park
+
+def aplicar_peso_zonas_verdes_por_arista(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park):
+    from shapely.geometry import Point, LineString
+    import geopandas as gpd
     for u, v, data in G.edges(data=True):
         arista = gpd.GeoDataFrame([data], geometry=[LineString([Point(G.nodes[u]['x'], G.nodes[u]['y']), 
                                                                 Point(G.nodes[v]['x'], G.nodes[v]['y'])])])
         distancia, es_dog_park = calcular_distancia_y_tipo_zonas_verdes(arista.iloc[0], zonas_verdes_gdf)
+        data['distancia_zona_verde'], data['es_dog_park'] = distancia, bool(es_dog_park)
+        # El peso se deriva siempre de la longitud base, así se puede volver a aplicar
+        data['weight'] = data.setdefault('longitud', data['weight'])
         if distancia < distancia_umbral:
             if es_dog_park:
                 data['weight'] *= factor_reduccion_dog_park
             else:
                 data['weight'] *= factor_reduccion
-                
-def calcular_distancia_entre_nodos(G, nodo1, nodo2):
-    y1, x1 = G.nodes[nodo1]['y'], G.nodes[nodo1]['x']
-    y2, x2 = G.nodes[nodo2]['y'], G.nodes[nodo2]['x']
-    return distance((y1, x1), (y2, x2)).meters
+    dist.invalidar_cache(G)
+
+def posiciones_gemelas(origen, destino):
+    # Para cada posición u -> v de una adyacencia CSR, la posición de v -> u
+    n = int(max(origen.max(), destino.max())) + 1 if len(origen) else 0
+    claves = origen.astype(np.int64) * n + destino
+    orden = np.argsort(claves, kind='stable')
+    return orden[np.searchsorted(claves[orden], destino.astype(np.int64) * n + origen)]
+
+class CapaZonasVerdes:
+    # Pesos derivados de la longitud base de cada arista y de su zona verde más cercana. Guarda la distancia
+    # y el tipo dog park de cada arista para cambiar factores o parques sin reconstruir el grafo
+    def __init__(self, G, zonas_verdes_gdf, distancia_umbral=10, factor_reduccion=0.5, factor_reduccion_dog_park=0.7,
+                 recalcular=True):
+        self.G = G
+        self.zonas_verdes_gdf = zonas_verdes_gdf.reset_index(drop=True)
+        self.distancia_umbral = distancia_umbral
+        self.factor_reduccion = factor_reduccion
+        self.factor_reduccion_dog_park = factor_reduccion_dog_park
+
+        if getattr(G, 'compacto', False):
+            # Cada arista no dirigida una vez; al escribir se actualizan sus dos sentidos en el CSR
+            origen = np.repeat(np.arange(len(G)), np.diff(G.inicio_vecinos))
+            self.posiciones = np.flatnonzero(origen <= G.vecinos)
+            self.gemelas = posiciones_gemelas(origen, G.vecinos)[self.posiciones]
+            u, v = origen[self.posiciones], G.vecinos[self.posiciones]
+            x, y = G.x, G.y
+            self.longitudes = np.array(G.longitudes[self.posiciones], dtype=np.float64)
+            self.distancias = np.array(G.distancia_zona_verde[self.posiciones], dtype=np.float64)
+            self.es_dog_park = np.array(G.es_dog_park[self.posiciones], dtype=bool)
+            # Los arrays del artefacto están mapeados en solo lectura
+            G.pesos, G.distancia_zona_verde, G.es_dog_park = (np.array(G.pesos), np.array(G.distancia_zona_verde),
+                                                               np.array(G.es_dog_park))
+        else:
+            indice, lat, lon = dist.coordenadas_nodos(G)
+            self.aristas = [data for _, _, data in G.edges(data=True)]
+            u = np.array([indice[a] for a, _ in G.edges()], dtype=np.int64)
+            v = np.array([indice[b] for _, b in G.edges()], dtype=np.int64)
+            x, y = lon, lat
+            self.longitudes = np.array([data.setdefault('longitud', data['weight']) for data in self.aristas], dtype=np.float64)
+            self.distancias = np.array([data.get('distancia_zona_verde', np.inf) for data in self.aristas], dtype=np.float64)
+            self.es_dog_park = np.array([data.get('es_dog_park', False) for data in self.aristas], dtype=bool)
+
+        # Centroides de las aristas y su índice espacial, para localizar las aristas afectadas por un parque
+        import shapely
+        coordenadas = np.stack([np.column_stack([x[u], y[u]]), np.column_stack([x[v], y[v]])], axis=1)
+        self.centroides = shapely.centroid(shapely.linestrings(coordenadas))
+        self.indice = shapely.STRtree(self.centroides)
+        if recalcular:
+            self.distancias, self.es_dog_park = calcular_distancias_y_tipo_zonas_verdes_en_bloque(
+                self.centroides, self.zonas_verdes_gdf)
+        self.escribir(np.arange(len(self.longitudes)))
+
+    def factores(self, posiciones=slice(None)):
+        return np.where(self.distancias[posiciones] < self.distancia_umbral,
+                        np.where(self.es_dog_park[posiciones], self.factor_reduccion_dog_park, self.factor_reduccion), 1.0)
+
+    def escribir(self, posiciones):
+        # Recalcula el peso de las aristas indicadas y lo guarda en el grafo; devuelve cuántas se tocaron
+        pesos = self.longitudes[posiciones] * self.factores(posiciones)
+        if getattr(self.G, 'compacto', False):
+            for destino in (self.posiciones[posiciones], self.gemelas[posiciones]):
+                self.G.pesos[destino] = pesos
+                self.G.distancia_zona_verde[destino] = self.distancias[posiciones]
+                self.G.es_dog_park[destino] = self.es_dog_park[posiciones]
+        else:
+            for k, peso in zip(posiciones.tolist(), pesos.tolist()):
+                data = self.aristas[k]
+                data['weight'] = peso
+                data['distancia_zona_verde'] = float(self.distancias[k])
+                data['es_dog_park'] = bool(self.es_dog_park[k])
+        if len(posiciones):
+            dist.invalidar_cache(self.G)
+        instr.contar('aristas_reponderadas', len(posiciones))
+        return len(posiciones)
+
+    def cambiar_factores(self, distancia_umbral=None, factor_reduccion=None, factor_reduccion_dog_park=None):
+        # Reaplica los factores en bloque y solo escribe las aristas cuyo factor cambia
+        anteriores = self.factores()
+        if distancia_umbral is not None:
+            self.distancia_umbral = distancia_umbral
+        if factor_reduccion is not None:
+            self.factor_reduccion = factor_reduccion
+        if factor_reduccion_dog_park is not None:
+            self.factor_reduccion_dog_park = factor_reduccion_dog_park
+        return self.escribir(np.flatnonzero(self.factores() != anteriores))
+
+    def actualizar_alrededor(self, geometria):
+        # Solo pueden cambiar las aristas cuyo centroide cae en la caja de la zona verde: es la misma relación
+        # con el índice espacial que usa calcular_distancias_y_tipo_zonas_verdes_en_bloque
+        posiciones = self.indice.query(geometria)
+        self.distancias[posiciones], self.es_dog_park[posiciones] = calcular_distancias_y_tipo_zonas_verdes_en_bloque(
+            self.centroides[posiciones], self.zonas_verdes_gdf)
+        return self.escribir(posiciones)
+
+    def añadir_zona_verde(self, geometria, **atributos):
+        import geopandas as gpd
+        import pandas as pd
+        zona = gpd.GeoDataFrame([atributos], geometry=[geometria], crs=self.zonas_verdes_gdf.crs)
+        self.zonas_verdes_gdf = gpd.GeoDataFrame(pd.concat([self.zonas_verdes_gdf, zona], ignore_index=True),
+                                                 crs=self.zonas_verdes_gdf.crs)
+        return self.actualizar_alrededor(geometria)
+
+    def eliminar_zona_verde(self, indice_zona):
+        geometria = self.zonas_verdes_gdf.geometry.iloc[indice_zona]
+        self.zonas_verdes_gdf = self.zonas_verdes_gdf.drop(self.zonas_verdes_gdf.index[indice_zona]).reset_index(drop=True)
+        return self.actualizar_alrededor(geometria)
+
+def aplicar_peso_zonas_verdes_en_bloque(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park):
+    # Los pesos se derivan de la longitud base (atributo 'longitud'), así que se puede volver a aplicar
+    capa = CapaZonasVerdes(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park)
+    return capa.distancias, capa.es_dog_park
+
+def aplicar_peso_zonas_verdes(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park, en_bloque=True):
+    if en_bloque:
+        aplicar_peso_zonas_verdes_en_bloque(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park)
+    else:
+        aplicar_peso_zonas_verdes_por_arista(G, zonas_verdes_gdf, distancia_umbral, factor_reduccion, factor_reduccion_dog_park)
+
+def calcular_distancia_entre_nodos(G, nodo1, nodo2, precision='haversine'):
+    # precision='geodesica' mantiene el cálculo exacto de geopy donde haga falta
+    return dist.distancia_entre_nodos(G, nodo1, nodo2, precision)
 
 def calcular_distancia_a_zonas_verdes(arista, zonas_verdes_gdf):
+    from shapely.ops import nearest_points
     punto_arista = arista.geometry.centroid
     puntos_zonas_verdes = zonas_verdes_gdf.geometry.apply(lambda x: nearest_points(punto_arista, x)[1])
     distancia_minima = min([punto_arista.distance(punto) for punto in puntos_zonas_verdes])
     return distancia_minima
 
-def buscar_rutas(G, nodo_actual, nodo_inicio, ruta_actual, distancia_actual, distancia_max, rutas, visitados):
-    # Comprobación de límites: detiene la búsqueda si se excede la distancia máxima o se revisita un nodo en una ruta menos eficiente
-    if distancia_actual > distancia_max or (nodo_actual in visitados and visitados[nodo_actual] <= distancia_actual):
-        return
-
-    # Comprobar si hemos vuelto al nodo de inicio y la ruta tiene más de un nodo, en cuyo caso, se añade a la lista de rutas
-    if nodo_actual == nodo_inicio and len(ruta_actual) > 1:
-        rutas.append(ruta_actual.copy())
-        return
-    # Marcar el nodo actual como visitado con la distancia actual
-    visitados[nodo_actual] = distancia_actual
-
-    # Explorar todos los vecinos del nodo actual
-    for vecino in G.neighbors(nodo_actual):
-        # Comprobar si el vecino no está en la ruta actual o es el nodo de inicio (para cerrar la ruta)
-        if vecino not in ruta_actual or (vecino == nodo_inicio and len(ruta_actual) > 1):
-            # Añadir el vecino a la ruta actual y actualizar la distancia
+def buscar_rutas(G, nodo_inicio, distancia_max, max_rutas, max_expansiones, tiempo_max=None):
+    # Búsqueda iterativa en profundidad (sin recursión) de rutas circulares que vuelven a nodo_inicio.
+    # Se conservan las max_rutas de menor coste ponderado (longitud con la reducción por zonas verdes), así
+    # que el resultado no depende del orden en que aparecen los ciclos. max_expansiones se reparte entre las
+    # aristas que salen del inicio para explorar todas las direcciones; tiempo_max es un tope opcional
+    limite_tiempo = None if tiempo_max is None else time.perf_counter() + tiempo_max
+    # Distancia en línea recta de cada nodo al inicio, escalada por el menor cociente longitud/distancia
+    # del grafo: cota inferior de lo que falta para cerrar la ruta
+    factor_cota = dist.factor_cota_inferior(G)
+    distancias_a_inicio = {nodo_inicio: 0}
+
+    # Montículo con las mejores rutas: la raíz es la peor (coste negado) y, a igual coste, la última hallada
+    mejores = []
+    en_mejores = set()
+    hallazgos = 0
+    primeras = list(dist.vecinos_aristas(G, nodo_inicio))
+    restantes = max_expansiones
+    expandidos = 1
+    agotado = False
+
+    for k, primera in enumerate(primeras):
+        # Cada arista de salida recibe una parte igual de lo que queda del presupuesto
+        presupuesto = restantes // (len(primeras) - k)
+        ruta_actual = [nodo_inicio]
+        en_ruta = {nodo_inicio}  # Conjunto para comprobar pertenencia a la ruta en O(1)
+        distancias = [0]
+        costes = [0]
+        pila = [iter([primera])]
+        usados = 0
+
+        while pila and usados < presupuesto:
+            if limite_tiempo is not None and time.perf_counter() > limite_tiempo:
+                agotado = True
+                break
+
+            siguiente = next(pila[-1], None)
+            if siguiente is None:
+                # Sin más vecinos que explorar: retroceder (backtracking)
+                pila.pop()
+                en_ruta.discard(ruta_actual.pop())
+                distancias.pop()
+                costes.pop()
+                continue
+
+            # La distancia se mide con la longitud de la arista; el peso solo ordena las rutas por preferencia
+            vecino, longitud, peso = siguiente
+            nueva_distancia = distancias[-1] + longitud
+            nuevo_coste = costes[-1] + peso
+            if nueva_distancia > distancia_max:
+                continue
+            # Los pesos no son negativos: si el coste ya iguala al de la peor guardada, no puede entrar
+            if len(mejores) >= max_rutas and nuevo_coste >= -mejores[0][0]:
+                continue
+
+            # Cerrar la ruta si volvemos al inicio con al menos dos nodos intermedios
+            if vecino == nodo_inicio:
+                if len(ruta_actual) > 2:
+                    ruta = tuple(ruta_actual) + (nodo_inicio,)
+                    # El mismo ciclo en sentido contrario tiene el mismo coste: basta mirar las guardadas
+                    if ruta[::-1] not in en_mejores:
+                        hallazgos += 1
+                        heapq.heappush(mejores, (-nuevo_coste, -hallazgos, ruta))
+                        en_mejores.add(ruta)
+                        if len(mejores) > max_rutas:
+                            en_mejores.discard(heapq.heappop(mejores)[2])
+                continue
+            if vecino in en_ruta:
+                continue
+
+            # Poda: descartar el vecino si ni volviendo en línea recta se puede cerrar la ruta dentro del límite
+            if vecino not in distancias_a_inicio:
+                distancias_a_inicio[vecino] = factor_cota * dist.distancia_entre_nodos(G, vecino, nodo_inicio, usar_aristas=False)
+            if nueva_distancia + distancias_a_inicio[vecino] > distancia_max:
+                continue
+
             ruta_actual.append(vecino)
-            nueva_distancia = distancia_actual + calcular_distancia_entre_nodos(G, nodo_actual, vecino)
+            en_ruta.add(vecino)
+            distancias.append(nueva_distancia)
+            costes.append(nuevo_coste)
+            pila.append(iter(dist.vecinos_aristas(G, vecino)))
+            usados += 1
 
-            # Llamada recursiva para continuar buscando desde el vecino
-            buscar_rutas(G, vecino, nodo_inicio, ruta_actual, nueva_distancia, distancia_max, rutas, visitados)
+        expandidos += usados
+        restantes -= usados
+        if agotado:
+            break
 
-            # Quitar el vecino de la ruta actual (backtracking)
-            ruta_actual.pop()
+    instr.contar('nodos_expandidos', expandidos)
+    instr.contar('rutas_candidatas', len(mejores))
+    # De menor a mayor coste; a igual coste, en el orden en que se encontraron
+    return [list(ruta) for _, _, ruta in sorted(mejores, key=lambda entrada: (-entrada[0], -entrada[1]))]
 
-def encontrar_rutas_circulares(G, nodo_inicio, distancia_max):
-    # Lista para almacenar todas las rutas encontradas
-    rutas = []
-    # Iniciar la búsqueda de rutas con la función de backtracking
-    buscar_rutas(G, nodo_inicio, nodo_inicio, [nodo_inicio], 0, distancia_max, rutas, {})
-    # Devolver las rutas encontradas
-    return rutas
+def encontrar_rutas_circulares(G, nodo_inicio, distancia_max, max_rutas=50, max_expansiones=100000, tiempo_max=None):
+    # Devuelve las max_rutas rutas cerradas de menor coste ponderado encontradas con max_expansiones nodos
+    # expandidos; el resultado es el mismo en cada llamada salvo que se fije tiempo_max
+    return buscar_rutas(G, nodo_inicio, distancia_max, max_rutas, max_expansiones, tiempo_max)
 
-def puntuar_ruta(ruta, G, zonas_verdes_gdf, perfil_perro):
+def factores_perfil(perfil_perro):
     # Obtener el tamaño de la raza del perro del diccionario
     raza = perfil_perro.get('raza')
     tamaño_raza = cp.caracteristicas_perros.get(raza, {"Tamaño": "Mediano"})["Tamaño"].lower()
@@ -105,13 +326,58 @@ def puntuar_ruta(ruta, G, zonas_verdes_gdf, perfil_perro):
     factor_tamaño = {'pequeño': 1, 'mediano': 2, 'grande': 3}.get(tamaño_raza, 2)
     # Factor de edad
     factor_edad = 1 if perfil_perro.get('edad', 5) < 8 else 1.5  # Mayor puntaje para perros mayores
-    # Calcular la longitud total de la ruta
-    longitud_ruta = sum(calcular_distancia_entre_nodos(G, ruta[i], ruta[i+1]) for i in range(len(ruta)-1))
-    # Calcular la proximidad a zonas verdes
-    proximidad_zonas_verdes = sum(calcular_distancia_a_zonas_verdes(gpd.GeoDataFrame([{'geometry': Point(G.nodes[n]['x'], G.nodes[n]['y'])}]), zonas_verdes_gdf) for n in ruta) / len(ruta)
-    # Calcular la puntuación de la ruta
-    puntuacion = (longitud_ruta * factor_tamaño + proximidad_zonas_verdes) * factor_edad
-    return puntuacion
+    return factor_tamaño, factor_edad
+
+def distancias_nodos_zonas_verdes(G, zonas_verdes_gdf):
+    import shapely
+    # Distancia de cada nodo a la zona verde más cercana, calculada una vez por grafo y capa de zonas verdes
+    cache = G.graph.get('distancias_nodos_zonas_verdes')
+    if cache is None or cache[0] is not zonas_verdes_gdf or len(cache[1]) != G.number_of_nodes():
+        _, lat, lon = dist.coordenadas_nodos(G)
+        distancias = np.full(len(lat), np.inf)
+        if not zonas_verdes_gdf.empty:
+            (indices_puntos, _), distancias_cercanas = zonas_verdes_gdf.sindex.nearest(
+                shapely.points(lon, lat), return_all=False, return_distance=True)
+            distancias[indices_puntos] = distancias_cercanas
+        cache = (zonas_verdes_gdf, distancias)
+        G.graph['distancias_nodos_zonas_verdes'] = cache
+    return cache[1]
+
+def indices_rutas(rutas, G):
+    # Índices de nodo de todas las rutas concatenados y la ruta a la que pertenece cada uno
+    indice, _, _ = dist.coordenadas_nodos(G)
+    tamaños = np.array([len(ruta) for ruta in rutas], dtype=np.int64)
+    nodos = np.fromiter((indice[n] for ruta in rutas for n in ruta), dtype=np.int64, count=int(tamaños.sum()))
+    return nodos, np.repeat(np.arange(len(rutas)), tamaños), tamaños
+
+def longitudes_rutas(rutas, G):
+    # Segmentos consecutivos dentro de cada ruta: longitud base de la arista si son adyacentes (sin la
+    # reducción por zonas verdes, que ya entra en la puntuación con la proximidad), haversine si no
+    _, lat, lon = dist.coordenadas_nodos(G)
+    nodos, ruta_de_nodo, _ = indices_rutas(rutas, G)
+    mismo_tramo = ruta_de_nodo[1:] == ruta_de_nodo[:-1]
+    origen, destino = nodos[:-1][mismo_tramo], nodos[1:][mismo_tramo]
+    longitudes = np.asarray(dist.matriz_longitudes(G)[origen, destino]) if len(origen) else np.empty(0)
+    segmentos = np.where(longitudes != 0, longitudes, dist.haversine(lat[origen], lon[origen], lat[destino], lon[destino]))
+    return np.bincount(ruta_de_nodo[:-1][mismo_tramo], weights=segmentos, minlength=len(rutas))
+
+def metricas_rutas(rutas, G, zonas_verdes_gdf):
+    # Longitud y proximidad media a zonas verdes de todas las rutas en una sola pasada con arrays
+    longitudes = longitudes_rutas(rutas, G)
+    nodos, ruta_de_nodo, tamaños = indices_rutas(rutas, G)
+    distancias_nodos = distancias_nodos_zonas_verdes(G, zonas_verdes_gdf)
+    instr.contar('rutas_puntuadas', len(rutas))
+    proximidades = np.bincount(ruta_de_nodo, weights=distancias_nodos[nodos], minlength=len(rutas)) / tamaños
+    return longitudes, proximidades
+
+def puntuar_rutas(rutas, G, zonas_verdes_gdf, perfil_perro):
+    factor_tamaño, factor_edad = factores_perfil(perfil_perro)
+    longitudes, proximidades = metricas_rutas(rutas, G, zonas_verdes_gdf)
+    # Calcular la puntuación de las rutas
+    return (longitudes * factor_tamaño + proximidades) * factor_edad
+
+def puntuar_ruta(ruta, G, zonas_verdes_gdf, perfil_perro):
+    return float(puntuar_rutas([ruta], G, zonas_verdes_gdf, perfil_perro)[0])
 
 def estimar_distancia(duracion, perfil_perro):
     # Obtiene la raza del perro desde el perfil
@@ -121,40 +387,64 @@ def estimar_distancia(duracion, perfil_perro):
     # Calcula la distancia basada en la duración del paseo y la velocidad
     return duracion * velocidad
 
-def generar_rutas(G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf):
+def generar_candidatas(G, nodo_inicio, distancia_estimada, zonas_verdes_gdf, estrategia='ciclos'):
+    # estrategia: 'ciclos' (búsqueda en profundidad de rutas cerradas) o 'zonas_verdes' (bucles de la
+    # longitud estimada que pasan por una o dos zonas verdes, ver bucles_zonas_verdes)
+    if estrategia == 'zonas_verdes':
+        import bucles_zonas_verdes
+        return bucles_zonas_verdes.generar_bucles(G, nodo_inicio, distancia_estimada, zonas_verdes_gdf)
+    if estrategia == 'ciclos':
+        return encontrar_rutas_circulares(G, nodo_inicio, distancia_estimada)
+    raise ValueError(f"Estrategia de rutas desconocida: {estrategia}")
+
+def generar_rutas(G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf, estrategia='ciclos'):
     distancia_estimada = estimar_distancia(duracion_paseo, perfil_perro)
-    rutas_posibles = encontrar_rutas_circulares(G, nodo_mas_cercano, distancia_estimada)
-    mejor_ruta = seleccionar_ruta(rutas_posibles, G, zonas_verdes_gdf, perfil_perro, nodo_mas_cercano)
+    with instr.etapa('buscar_rutas'):
+        rutas_posibles = generar_candidatas(G, nodo_mas_cercano, distancia_estimada, zonas_verdes_gdf, estrategia)
+    with instr.etapa('seleccionar_ruta'):
+        mejor_ruta = seleccionar_ruta(rutas_posibles, G, zonas_verdes_gdf, perfil_perro, nodo_mas_cercano)
     return mejor_ruta
 
 def seleccionar_ruta(rutas, G, zonas_verdes_gdf, perfil_perro, nodo_mas_cercano):
     if not rutas:
-        return [[nodo_mas_cercano, nodo_mas_cercano]]
-    # Evaluar y puntuar cada ruta
-    puntuaciones_rutas = [(ruta, puntuar_ruta(ruta, G, zonas_verdes_gdf, perfil_perro)) for ruta in rutas]
-    # Ordenar las rutas por puntuación (menor es mejor)
-    puntuaciones_rutas.sort(key=lambda x: x[1])
-    # Devolver la ruta con la mejor puntuación
-    return puntuaciones_rutas[0][0] if puntuaciones_rutas else None
+        return [nodo_mas_cercano, nodo_mas_cercano]
+    factor_tamaño, factor_edad = factores_perfil(perfil_perro)
+    # Longitud real de todas las rutas en una sola llamada: longitud * factores es una cota inferior de la
+    # puntuación porque la proximidad a zonas verdes (el término de preferencia) nunca es negativa
+    longitudes = longitudes_rutas(rutas, G)
+    cotas = longitudes * factor_tamaño * factor_edad
+    distancias_nodos = distancias_nodos_zonas_verdes(G, zonas_verdes_gdf)
+    indice, _, _ = dist.coordenadas_nodos(G)
+
+    # Evaluar las rutas de menor a mayor cota y parar cuando ninguna restante pueda mejorar la mejor
+    mejor, mejor_puntuacion = None, np.inf
+    puntuadas = 0
+    for i in np.argsort(cotas, kind='stable'):
+        if cotas[i] > mejor_puntuacion:
+            break
+        puntuadas += 1
+        proximidad = distancias_nodos[[indice[n] for n in rutas[i]]].mean()
+        puntuacion = (longitudes[i] * factor_tamaño + proximidad) * factor_edad
+        # Menor es mejor; en caso de empate se mantiene la primera ruta de la lista
+        if mejor is None or puntuacion < mejor_puntuacion or (puntuacion == mejor_puntuacion and i < mejor):
+            mejor, mejor_puntuacion = i, puntuacion
+    instr.contar('rutas_puntuadas', puntuadas)
+    return rutas[mejor]
 
 def crear_grafo_desde_geojson(nodos_gdf, aristas_gdf):
+    import networkx as nx
     G = nx.Graph()
     for _, nodo in nodos_gdf.iterrows():
         G.add_node(nodo['osmid'], x=nodo['geometry'].x, y=nodo['geometry'].y)
     for _, arista in aristas_gdf.iterrows():
         # Usar longitud como peso, o un valor predeterminado si no está disponible
         longitud = arista.get('length', 1.0)
-        G.add_edge(arista['u'], arista['v'], weight=longitud)
+        G.add_edge(arista['u'], arista['v'], weight=longitud, longitud=longitud)
         G.graph['crs'] = 'epsg:4326'  # Establecer el CRS aquí
     return G
 
-def visualizar_rutas(G, rutas, latitud_actual, longitud_actual):
-    mapa = folium.Map(location=[latitud_actual, longitud_actual], zoom_start=15)
-    for ruta in rutas:
-        # Verificar si la ruta contiene al menos una arista
-        if len(ruta) > 1 and ruta[0] != ruta[1]:
-            ox.plot_route_folium(G, ruta, route_map=mapa)
-    # Guardar el mapa en un archivo HTML
-    nombre_archivo_mapa = 'rutas_paseo.html'
-    mapa.save(nombre_archivo_mapa)
-    return nombre_archivo_mapa
+def visualizar_rutas(G, rutas, latitud_actual, longitud_actual, directorio='.'):
+    # Dibuja las rutas con folium a partir de las coordenadas de los nodos (sin osmnx) y guarda el mapa
+    # en un archivo HTML con nombre único
+    nombre_archivo_mapa = salida_rutas.nombre_archivo_unico(directorio)
+    return salida_rutas.dibujar_mapa(G, rutas, latitud_actual, longitud_actual, nombre_archivo_mapa)
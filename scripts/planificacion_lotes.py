@@ -0,0 +1,135 @@
+import argparse
+import json
+import math
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import carga_datos_yDevolver_json as carga_datos
+import grafo_compilado as gc
+import grafo_compacto
+import instrumentacion as instr
+import nodos_rutas_y_pesos as nrp
+import main
+
+# Grafo y zonas verdes de cada proceso worker, cargados una vez desde el artefacto mapeado en memoria
+recursos_worker = {}
+
+def inicializar_worker(directorio_grafo, nombre_archivo_zonas_verdes, configuracion_instrumentacion=None):
+    # Cada worker usa la misma configuración de instrumentación que el proceso principal
+    if configuracion_instrumentacion is not None:
+        instr.configurar(**configuracion_instrumentacion)
+    artefacto = gc.cargar_grafo_compilado(directorio_grafo)
+    recursos_worker['G'] = grafo_compacto.desde_compilado(artefacto)
+    recursos_worker['zonas_verdes_gdf'] = carga_datos.zonas_verdes_gdf(nombre_archivo_zonas_verdes)
+
+def clase_distancia(duracion_paseo, perfil_perro, intervalo_distancia=None):
+    # Distancia estimada del paseo redondeada a su clase, para agrupar perros con paseos parecidos. Con
+    # intervalo_distancia (metros) las clases tienen todas el mismo ancho; sin él son relativas y ningún perro
+    # queda a más de nrp.TOLERANCIA_DISTANCIA de la distancia de su clase, sea el paseo corto o largo
+    distancia = nrp.estimar_distancia(duracion_paseo, perfil_perro)
+    if intervalo_distancia is not None:
+        return max(1, round(distancia / intervalo_distancia)) * intervalo_distancia
+    # Clases (1 + t)^(2k): el redondeo en escala logarítmica deja cada distancia a menos de un factor 1 + t
+    paso = 2 * math.log1p(nrp.TOLERANCIA_DISTANCIA)
+    return math.exp(round(math.log(max(distancia, 1.0)) / paso) * paso)
+
+def planificar_grupo(nodo_inicio, distancia, perfiles, G, zonas_verdes_gdf):
+    # Una sola generación de candidatas para todo el grupo
+    with instr.etapa('buscar_rutas'):
+        rutas = nrp.encontrar_rutas_circulares(G, nodo_inicio, distancia)
+    if not rutas:
+        return [nrp.seleccionar_ruta(rutas, G, zonas_verdes_gdf, perfil, nodo_inicio) for perfil in perfiles]
+
+    # Puntuación vectorizada: una fila por perro, una columna por ruta candidata
+    with instr.etapa('puntuar_rutas'):
+        longitudes, proximidades = nrp.metricas_rutas(rutas, G, zonas_verdes_gdf)
+        factores = np.array([nrp.factores_perfil(perfil) for perfil in perfiles], dtype=np.float64)
+        puntuaciones = (longitudes[None, :] * factores[:, :1] + proximidades[None, :]) * factores[:, 1:]
+    return [rutas[i] for i in np.argmin(puntuaciones, axis=1)]
+
+def planificar_grupo_con_traza(nodo_inicio, distancia, perfiles, G, zonas_verdes_gdf):
+    # Devuelve las rutas del grupo y su traza (None si la instrumentación está desactivada o va a un registro)
+    traza = instr.iniciar_traza('grupo')
+    instr.contar('perros', len(perfiles))
+    try:
+        rutas = planificar_grupo(nodo_inicio, distancia, perfiles, G, zonas_verdes_gdf)
+    except Exception:
+        instr.finalizar_traza(traza)
+        raise
+    return rutas, instr.finalizar_traza(traza)
+
+def planificar_grupo_en_worker(nodo_inicio, distancia, perfiles):
+    return planificar_grupo_con_traza(nodo_inicio, distancia, perfiles, recursos_worker['G'],
+                                      recursos_worker['zonas_verdes_gdf'])
+
+def crear_pool(num_procesos, directorio_grafo, nombre_archivo_zonas_verdes='parques.geojson'):
+    # Pool de larga duración para pasar a planificar_lote: los workers cargan el grafo y las zonas verdes
+    # una sola vez y sirven todos los lotes
+    return ProcessPoolExecutor(max_workers=num_procesos, initializer=inicializar_worker,
+                               initargs=(directorio_grafo, nombre_archivo_zonas_verdes, instr.configuracion_serializable()))
+
+def planificar_lote(json_inputs, G, zonas_verdes_gdf, directorio_grafo=None, nombre_archivo_zonas_verdes='parques.geojson',
+                    num_procesos=None, intervalo_distancia=None, pool=None):
+    # Devuelve una respuesta JSON por perro, en el mismo orden que json_inputs. Con pool (ver crear_pool) los
+    # grupos se reparten entre sus procesos; con num_procesos y directorio_grafo se crea un pool solo para
+    # este lote. Un perro con datos incorrectos recibe su propio error sin afectar al resto del lote
+    respuestas = [None] * len(json_inputs)
+    datos_perros = {}
+    for i, json_input in enumerate(json_inputs):
+        datos_perro = carga_datos.cargar_datos_perro(json_input)
+        error = carga_datos.error_datos_perro(datos_perro)
+        if error is None:
+            datos_perros[i] = datos_perro
+        else:
+            respuestas[i] = json.dumps({'error': error})
+    if not datos_perros:
+        return respuestas
+
+    # Ajustar todos los puntos de inicio a nodos del grafo en una sola llamada
+    indices = list(datos_perros)
+    nodos_inicio = carga_datos.obtener_ubicacion_actual(G, [datos_perros[i]['latitud'] for i in indices],
+                                                         [datos_perros[i]['longitud'] for i in indices])
+
+    # Agrupar por nodo de inicio y clase de distancia del paseo
+    grupos = {}
+    for i, nodo_inicio in zip(indices, np.asarray(nodos_inicio).tolist()):
+        datos_perro = datos_perros[i]
+        perfil_perro = {'tamaño': datos_perro['tamaño'], 'edad': datos_perro['edad'], 'raza': datos_perro['raza']}
+        clave = (nodo_inicio, clase_distancia(datos_perro['duracion'], perfil_perro, intervalo_distancia))
+        grupos.setdefault(clave, []).append((i, perfil_perro))
+
+    # Repartir los grupos entre procesos que comparten el grafo de solo lectura
+    claves = list(grupos)
+    perfiles = [[perfil for _, perfil in grupos[clave]] for clave in claves]
+    if pool is not None:
+        resultados = list(pool.map(planificar_grupo_en_worker, [c[0] for c in claves], [c[1] for c in claves], perfiles))
+    elif num_procesos and directorio_grafo:
+        with crear_pool(num_procesos, directorio_grafo, nombre_archivo_zonas_verdes) as pool_lote:
+            resultados = list(pool_lote.map(planificar_grupo_en_worker, [c[0] for c in claves], [c[1] for c in claves],
+                                            perfiles))
+    else:
+        resultados = [planificar_grupo_con_traza(clave[0], clave[1], p, G, zonas_verdes_gdf)
+                      for clave, p in zip(claves, perfiles)]
+
+    for clave, (rutas_grupo, traza) in zip(claves, resultados):
+        for (i, _), ruta in zip(grupos[clave], rutas_grupo):
+            try:
+                respuestas[i] = carga_datos.generar_json_respuesta(ruta, None, json_inputs[i], G, traza)
+            except Exception as e:
+                respuestas[i] = json.dumps({'error': str(e)})
+    return respuestas
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Planifica en lote los paseos de varios perros (un JSON por línea)")
+    parser.add_argument('--procesos', type=int, default=None)
+    parser.add_argument('--directorio-grafo', default='grafo_burgos')
+    parser.add_argument('--intervalo-distancia', type=float, default=None, help="Metros por clase de distancia al agrupar perros (por defecto clases relativas, ver clase_distancia)")
+    args = parser.parse_args()
+
+    G, zonas_verdes_gdf = main.cargar_recursos(args.directorio_grafo)
+    json_inputs = [linea.strip() for linea in sys.stdin if linea.strip()]
+    pool = crear_pool(args.procesos, args.directorio_grafo) if args.procesos else None
+    for respuesta in planificar_lote(json_inputs, G, zonas_verdes_gdf, intervalo_distancia=args.intervalo_distancia, pool=pool):
+        print(respuesta)
+    if pool is not None:
+        pool.shutdown()
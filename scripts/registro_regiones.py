@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+import carga_datos_yDevolver_json as carga_datos
+import grafo_compilado as gc
+import grafo_compacto
+import instrumentacion as instr
+
+BYTES_POR_NODO = 200  # Estimación del diccionario de índices, la caché de vecinos y el índice espacial de cada nodo
+
+def leer_catalogo(archivo_catalogo):
+    # Catálogo JSON {nombre: {"directorio_grafo", "zonas_verdes", y opcionalmente "nodos", "aristas", "limites"}}.
+    # Las rutas relativas se resuelven respecto a la carpeta del catálogo
+    with open(archivo_catalogo, encoding='utf-8') as f:
+        catalogo = json.load(f)
+    base = os.path.dirname(os.path.abspath(archivo_catalogo))
+    regiones = {}
+    for nombre, datos in catalogo.items():
+        region = dict(datos)
+        for campo in ('directorio_grafo', 'zonas_verdes', 'nodos', 'aristas'):
+            if region.get(campo):
+                region[campo] = os.path.join(base, region[campo])
+        regiones[nombre] = region
+    return regiones
+
+def limites_artefacto(directorio_grafo):
+    # Caja de la región guardada en meta.json; los artefactos anteriores se miden con los arrays mapeados
+    meta = gc.leer_meta(directorio_grafo)
+    if meta is None:
+        return None
+    if 'limites' in meta:
+        return meta['limites']
+    x = np.load(os.path.join(directorio_grafo, 'x.npy'), mmap_mode='r')
+    y = np.load(os.path.join(directorio_grafo, 'y.npy'), mmap_mode='r')
+    return [float(x.min()), float(y.min()), float(x.max()), float(y.max())]
+
+def memoria_region(artefacto, zonas_verdes_gdf):
+    # Estimación de lo que ocupa una región cargada: arrays del artefacto (páginas mapeadas que acaban en
+    # memoria), estructuras por nodo que se construyen al usarla y la capa de zonas verdes
+    arrays = sum(valor.nbytes for nombre, valor in artefacto.items() if nombre != 'meta')
+    return int(arrays + BYTES_POR_NODO * artefacto['meta']['num_nodos']
+               + zonas_verdes_gdf.memory_usage(deep=True).sum())
+
+class RegistroRegiones:
+    # Grafos de varias ciudades o regiones: localiza la región de cada punto por su caja, la carga la primera
+    # vez que se pide y expulsa las usadas hace más tiempo cuando la memoria estimada supera memoria_max.
+    # Los arrays se mapean en memoria, así que varios procesos que carguen la misma región comparten páginas
+    def __init__(self, regiones, memoria_max=1 << 30, margen=0.002, parametros=None):
+        self.regiones = regiones
+        self.memoria_max = memoria_max
+        self.margen = margen  # Grados alrededor de cada caja en los que un punto todavía cuenta como dentro
+        self.parametros = parametros or {'distancia_umbral': 10, 'factor_reduccion': 0.5, 'factor_reduccion_dog_park': 0.7}
+        self.cargadas = OrderedDict()  # nombre -> (G, zonas_verdes_gdf, bytes)
+        self.cargando = {}
+        self.lock = threading.Lock()
+        self.memoria = 0
+        self.aciertos = 0
+        self.cargas = 0
+        self.expulsiones = 0
+
+        # Cajas de todas las regiones en un array para localizar puntos sin cargar ningún grafo
+        self.nombres = []
+        limites = []
+        for nombre, region in regiones.items():
+            caja = region.get('limites') or limites_artefacto(region['directorio_grafo'])
+            if caja is None:
+                # Sin artefacto todavía: se compila ahora para conocer su caja, pero no se carga
+                gc.obtener_grafo_compilado(region['directorio_grafo'], region['nodos'], region['aristas'],
+                                           region['zonas_verdes'], **self.parametros)
+                caja = limites_artefacto(region['directorio_grafo'])
+            self.nombres.append(nombre)
+            limites.append(caja)
+        self.limites = np.array(limites, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def desde_catalogo(cls, archivo_catalogo, **opciones):
+        return cls(leer_catalogo(archivo_catalogo), **opciones)
+
+    def localizar(self, latitud, longitud):
+        # Región cuya caja contiene el punto; si hay varias, la de menor área (la más específica)
+        lon_min, lat_min, lon_max, lat_max = self.limites.T
+        dentro = np.flatnonzero((lon_min - self.margen <= longitud) & (longitud <= lon_max + self.margen)
+                                & (lat_min - self.margen <= latitud) & (latitud <= lat_max + self.margen))
+        if len(dentro) == 0:
+            return None
+        areas = (lon_max[dentro] - lon_min[dentro]) * (lat_max[dentro] - lat_min[dentro])
+        return self.nombres[dentro[np.argmin(areas)]]
+
+    def cargar(self, nombre):
+        region = self.regiones[nombre]
+        if region.get('nodos') and region.get('aristas'):
+            # Con las fuentes disponibles se recompila o repondera si han cambiado
+            artefacto = gc.obtener_grafo_compilado(region['directorio_grafo'], region['nodos'], region['aristas'],
+                                                   region['zonas_verdes'], **self.parametros)
+        else:
+            artefacto = gc.cargar_grafo_compilado(region['directorio_grafo'])
+        G = grafo_compacto.desde_compilado(artefacto)
+        zonas_verdes_gdf = carga_datos.zonas_verdes_gdf(region['zonas_verdes'])
+        return G, zonas_verdes_gdf, memoria_region(artefacto, zonas_verdes_gdf)
+
+    def obtener(self, nombre):
+        # Devuelve (G, zonas_verdes_gdf) de la región; peticiones simultáneas de una región sin cargar
+        # esperan a una sola carga
+        with self.lock:
+            cargada = self.cargadas.get(nombre)
+            if cargada is not None:
+                self.cargadas.move_to_end(nombre)
+                self.aciertos += 1
+                return cargada[0], cargada[1]
+            futuro = self.cargando.get(nombre)
+            propio = futuro is None
+            if propio:
+                futuro = Future()
+                self.cargando[nombre] = futuro
+        if not propio:
+            G, zonas_verdes_gdf, _ = futuro.result()
+            return G, zonas_verdes_gdf
+
+        try:
+            with instr.etapa('cargar_region'):
+                resultado = self.cargar(nombre)
+        except Exception as e:
+            futuro.set_exception(e)
+            with self.lock:
+                del self.cargando[nombre]
+            raise
+        with self.lock:
+            del self.cargando[nombre]
+            self.cargadas[nombre] = resultado
+            self.memoria += resultado[2]
+            self.cargas += 1
+            self.expulsar()
+        instr.contar('regiones_cargadas')
+        futuro.set_result(resultado)
+        return resultado[0], resultado[1]
+
+    def expulsar(self):
+        # Llamar con el lock tomado. La región recién cargada nunca se expulsa; las peticiones en curso que
+        # usan una región expulsada conservan su referencia hasta terminar
+        while self.memoria > self.memoria_max and len(self.cargadas) > 1:
+            _, (_, _, tamaño) = self.cargadas.popitem(last=False)
+            self.memoria -= tamaño
+            self.expulsiones += 1
+
+    def region(self, latitud, longitud):
+        nombre = self.localizar(latitud, longitud)
+        if nombre is None:
+            raise ValueError(f"Ninguna región cubre el punto ({latitud}, {longitud})")
+        return nombre
+
+    def recursos(self, latitud, longitud):
+        return self.obtener(self.region(latitud, longitud))
+
+    def versiones(self):
+        # Versión del grafo de cada región según su meta.json, para conservar sus rutas en la caché
+        metas = [gc.leer_meta(region['directorio_grafo']) for region in self.regiones.values()]
+        return [meta['hash_fuentes'] for meta in metas if meta is not None]
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                'regiones': len(self.regiones),
+                'cargadas': list(self.cargadas),
+                'memoria_estimada': self.memoria,
+                'memoria_max': self.memoria_max,
+                'aciertos': self.aciertos,
+                'cargas': self.cargas,
+                'expulsiones': self.expulsiones,
+            }
@@ -0,0 +1,86 @@
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import distancias as dist
+import instrumentacion as instr
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Un solo hilo para dibujar mapas HTML fuera del camino de la respuesta
+pool_mapas = None
+
+def coordenadas_ruta(G, ruta):
+    # Arrays de latitud y longitud de los nodos de la ruta, leídos de los arrays de coordenadas del grafo
+    indice, lat, lon = dist.coordenadas_nodos(G)
+    posiciones = np.fromiter((indice[nodo] for nodo in ruta), dtype=np.int64, count=len(ruta))
+    return lat[posiciones], lon[posiciones]
+
+def codificar_polilinea(lat, lon, precision=5):
+    # Encoded polyline (formato de Google): diferencias entre puntos consecutivos en bloques de 5 bits
+    valores = np.rint(np.column_stack([lat, lon]) * 10 ** precision).astype(np.int64)
+    diferencias = np.diff(valores, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    diferencias = np.where(diferencias < 0, ~(diferencias << 1), diferencias << 1)
+    caracteres = []
+    for valor in diferencias.tolist():
+        while valor >= 0x20:
+            caracteres.append(chr((0x20 | (valor & 0x1f)) + 63))
+            valor >>= 5
+        caracteres.append(chr(valor + 63))
+    return ''.join(caracteres)
+
+def geojson_ruta(lat, lon):
+    # GeoJSON usa el orden (longitud, latitud)
+    return {'type': 'LineString', 'coordinates': np.column_stack([lon, lat]).tolist()}
+
+def serializar(datos):
+    # orjson si está instalado; si no, el módulo json de la biblioteca estándar
+    if orjson is not None:
+        return orjson.dumps(datos, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(datos)
+
+def respuesta_ruta(G, ruta, datos_perro, nombre_archivo_mapa=None, traza=None):
+    # Datos del perro más la ruta como lista de puntos, polilínea codificada y LineString GeoJSON; la traza
+    # de instrumentación se añade si se recibe
+    lat, lon = coordenadas_ruta(G, ruta)
+    respuesta = dict(datos_perro)
+    respuesta['ruta'] = [{'lat': y, 'lon': x} for y, x in zip(lat.tolist(), lon.tolist())]
+    respuesta['polilinea'] = codificar_polilinea(lat, lon)
+    respuesta['geojson'] = geojson_ruta(lat, lon)
+    if nombre_archivo_mapa is not None:
+        respuesta['mapa'] = nombre_archivo_mapa
+    if traza is not None:
+        respuesta['traza'] = traza
+    return serializar(respuesta)
+
+def nombre_archivo_unico(directorio='.'):
+    # Cada mapa en su propio archivo para que peticiones simultáneas no se pisen
+    return os.path.join(directorio, f"rutas_paseo_{uuid.uuid4().hex}.html")
+
+def dibujar_mapa(G, rutas, latitud_actual, longitud_actual, nombre_archivo_mapa):
+    with instr.etapa('dibujar_mapa'):
+        return dibujar_mapa_folium(G, rutas, latitud_actual, longitud_actual, nombre_archivo_mapa)
+
+def dibujar_mapa_folium(G, rutas, latitud_actual, longitud_actual, nombre_archivo_mapa):
+    import folium
+    mapa = folium.Map(location=[latitud_actual, longitud_actual], zoom_start=15)
+    for ruta in rutas:
+        # Verificar si la ruta contiene al menos una arista
+        if len(ruta) > 1 and ruta[0] != ruta[1]:
+            lat, lon = coordenadas_ruta(G, ruta)
+            folium.PolyLine(np.column_stack([lat, lon]).tolist(), weight=5, opacity=0.7).add_to(mapa)
+    mapa.save(nombre_archivo_mapa)
+    return nombre_archivo_mapa
+
+def programar_mapa(G, rutas, latitud_actual, longitud_actual, directorio='.'):
+    # Dibuja el mapa en segundo plano; el nombre del archivo se conoce antes de que esté escrito
+    global pool_mapas
+    if pool_mapas is None:
+        pool_mapas = ThreadPoolExecutor(max_workers=1)
+    nombre_archivo_mapa = nombre_archivo_unico(directorio)
+    futuro = pool_mapas.submit(dibujar_mapa, G, rutas, latitud_actual, longitud_actual, nombre_archivo_mapa)
+    return nombre_archivo_mapa, futuro
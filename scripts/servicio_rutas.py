@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import carga_datos_yDevolver_json as carga_datos
+import cache_rutas
+import distancias as dist
+import grafo_compilado as gc
+import grafo_compacto
+import indice_espacial
+import instrumentacion as instr
+import nodos_rutas_y_pesos as nrp
+import velocidad_y_distancia as vd
+import main
+import registro_regiones
+
+# Grafo y zonas verdes (o registro de regiones) del proceso worker, cargados por inicializar_worker
+recursos_worker = {}
+
+class ResolutorRutas:
+    # Atiende peticiones en hilos del proceso principal: ajusta el inicio, consulta la caché y elige la ruta de
+    # cada perro. La generación de candidatas, la parte cara, se agrupa por inicio, clase de duración,
+    # velocidad y estrategia: las peticiones simultáneas con la misma clave esperan a una sola generación,
+    # que se hace en pool_candidatas (procesos worker de crear_pool_procesos) o, sin él, en el propio hilo
+    def __init__(self, G, zonas_verdes_gdf, cache=None, registro=None, pool_candidatas=None, intervalo_duracion=5):
+        self.G = G
+        self.zonas_verdes_gdf = zonas_verdes_gdf
+        self.cache = cache
+        self.registro = registro
+        self.pool_candidatas = pool_candidatas
+        self.intervalo_duracion = intervalo_duracion
+        self.lock = threading.Lock()
+        # Generación de rutas candidatas en curso, compartida entre peticiones con la misma clave
+        self.candidatas_en_curso = {}
+        self.compartidas = 0
+        self.generadas = 0
+        # Últimos contadores recibidos de cada proceso worker, por pid
+        self.estadisticas_workers = {}
+
+    def atender(self, json_input):
+        # Devuelve (respuesta JSON, hubo error)
+        try:
+            return self.resolver(json_input), False
+        except Exception as e:
+            return json.dumps({'error': str(e)}), True
+
+    def resolver(self, json_input):
+        # Los datos incorrectos llegan a atender como excepción: respuesta de error y cuenta en errores
+        datos_perro = carga_datos.cargar_datos_perro(json_input)
+        error = carga_datos.error_datos_perro(datos_perro)
+        if error is not None:
+            raise ValueError(error)
+
+        traza = instr.iniciar_traza('servicio')
+        try:
+            region, G, zonas_verdes_gdf = self.recursos(datos_perro)
+            ruta = self.calcular_ruta(datos_perro, region, G, zonas_verdes_gdf)
+        except Exception:
+            instr.finalizar_traza(traza)
+            raise
+        return carga_datos.generar_json_respuesta(ruta, None, json_input, G, instr.finalizar_traza(traza))
+
+    def recursos(self, datos_perro):
+        # (nombre de la región o None, G, zonas_verdes_gdf)
+        if self.registro is None:
+            return None, self.G, self.zonas_verdes_gdf
+        with instr.etapa('region'):
+            region = self.registro.region(datos_perro['latitud'], datos_perro['longitud'])
+            G, zonas_verdes_gdf = self.registro.obtener(region)
+        return region, G, zonas_verdes_gdf
+
+    def calcular_ruta(self, datos_perro, region, G, zonas_verdes_gdf):
+        with instr.etapa('ajustar_inicio'):
+            nodo_mas_cercano = carga_datos.obtener_ubicacion_actual(G, datos_perro['latitud'], datos_perro['longitud'])
+        perfil_perro = {'tamaño': datos_perro['tamaño'], 'edad': datos_perro['edad'], 'raza': datos_perro['raza']}
+        duracion_paseo = datos_perro['duracion']
+
+        estrategia = datos_perro.get('estrategia', 'ciclos')
+
+        def generar(G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf, estrategia):
+            return self.generar_rutas(region, G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf,
+                                      estrategia)
+        return cache_rutas.generar_rutas_con_cache(self.cache, G, nodo_mas_cercano, duracion_paseo, perfil_perro,
+                                                   zonas_verdes_gdf, estrategia, generar)
+
+    def redondear_duracion(self, duracion):
+        return max(self.intervalo_duracion, round(duracion / self.intervalo_duracion) * self.intervalo_duracion)
+
+    def generar_rutas(self, region, G, nodo_mas_cercano, duracion_paseo, perfil_perro, zonas_verdes_gdf, estrategia):
+        # Como nrp.generar_rutas, pero con las candidatas compartidas entre las peticiones de la misma clave.
+        # Se generan para la duración redondeada a su clase para que sirvan a todas ellas
+        duracion_clase = self.redondear_duracion(duracion_paseo)
+        distancia_estimada = nrp.estimar_distancia(duracion_clase, perfil_perro)
+        clave = (region, id(G), nodo_mas_cercano, duracion_clase, vd.estimar_velocidad(perfil_perro.get('raza')),
+                 estrategia)
+        with instr.etapa('buscar_rutas'):
+            rutas_posibles = self.obtener_candidatas(clave, region, G, nodo_mas_cercano, distancia_estimada,
+                                                     zonas_verdes_gdf, estrategia)
+        with instr.etapa('seleccionar_ruta'):
+            return nrp.seleccionar_ruta(rutas_posibles, G, zonas_verdes_gdf, perfil_perro, nodo_mas_cercano)
+
+    def obtener_candidatas(self, clave, region, G, nodo_inicio, distancia_estimada, zonas_verdes_gdf, estrategia):
+        # Agrupar peticiones simultáneas: solo la primera genera las candidatas, el resto espera su resultado
+        with self.lock:
+            futuro = self.candidatas_en_curso.get(clave)
+            propio = futuro is None
+            if propio:
+                futuro = Future()
+                self.candidatas_en_curso[clave] = futuro
+            else:
+                self.compartidas += 1
+        if not propio:
+            instr.contar('candidatas_compartidas')
+            return futuro.result()
+
+        try:
+            futuro.set_result(self.generar_candidatas(region, G, nodo_inicio, distancia_estimada, zonas_verdes_gdf,
+                                                      estrategia))
+        except Exception as e:
+            futuro.set_exception(e)
+        finally:
+            with self.lock:
+                del self.candidatas_en_curso[clave]
+                self.generadas += 1
+        return futuro.result()
+
+    def generar_candidatas(self, region, G, nodo_inicio, distancia_estimada, zonas_verdes_gdf, estrategia):
+        if self.pool_candidatas is None:
+            return nrp.generar_candidatas(G, nodo_inicio, distancia_estimada, zonas_verdes_gdf, estrategia)
+        rutas, traza_worker, estadisticas_worker = self.pool_candidatas.submit(
+            generar_candidatas_en_worker, region, nodo_inicio, distancia_estimada, estrategia).result()
+        instr.incorporar(traza_worker)
+        with self.lock:
+            # Los contadores de cada worker crecen siempre: el último recibido es el vigente
+            anteriores = self.estadisticas_workers.get(estadisticas_worker['pid'])
+            if anteriores is None or anteriores['candidatas_generadas'] < estadisticas_worker['candidatas_generadas']:
+                self.estadisticas_workers[estadisticas_worker['pid']] = estadisticas_worker
+        return rutas
+
+    def estadisticas(self):
+        with self.lock:
+            estadisticas = {'candidatas_generadas': self.generadas, 'candidatas_compartidas': self.compartidas}
+        if self.cache is not None:
+            estadisticas['cache'] = self.cache.estadisticas()
+        if self.registro is not None:
+            estadisticas['regiones'] = self.registro.estadisticas()
+        if self.pool_candidatas is not None:
+            with self.lock:
+                estadisticas['workers'] = [self.estadisticas_workers[pid] for pid in sorted(self.estadisticas_workers)]
+        return estadisticas
+
+def precalentar(G, zonas_verdes_gdf):
+    # Deja hecho lo que si no pagaría la primera petición: importar scipy (csgraph de bucles_zonas_verdes),
+    # el KD-tree con las coordenadas proyectadas del artefacto, la matriz de longitudes con su cota inferior
+    # y las distancias de los nodos a las zonas verdes que usan la selección y la estrategia zonas_verdes
+    import bucles_zonas_verdes
+    indice_espacial.indice_espacial(G)
+    dist.matriz_longitudes(G)
+    dist.factor_cota_inferior(G)
+    nrp.distancias_nodos_zonas_verdes(G, zonas_verdes_gdf)
+    bucles_zonas_verdes.nodos_zonas_verdes(G, zonas_verdes_gdf)
+
+def inicializar_worker(directorio_grafo, nombre_archivo_zonas_verdes, archivo_regiones=None, memoria_regiones=1 << 30,
+                       configuracion_instrumentacion=None):
+    # Cada worker mapea en memoria el artefacto compilado (las páginas se comparten entre procesos) o carga
+    # bajo demanda las regiones del catálogo
+    if configuracion_instrumentacion is not None:
+        instr.configurar(**configuracion_instrumentacion)
+    recursos_worker['generadas'] = 0
+    if archivo_regiones:
+        recursos_worker['registro'] = registro_regiones.RegistroRegiones.desde_catalogo(archivo_regiones,
+                                                                                         memoria_max=memoria_regiones)
+        # Las regiones se cargan bajo demanda; al menos los módulos de scipy quedan importados
+        import bucles_zonas_verdes
+    else:
+        recursos_worker['G'] = grafo_compacto.desde_compilado(gc.cargar_grafo_compilado(directorio_grafo))
+        recursos_worker['zonas_verdes_gdf'] = carga_datos.zonas_verdes_gdf(nombre_archivo_zonas_verdes)
+        precalentar(recursos_worker['G'], recursos_worker['zonas_verdes_gdf'])
+
+def generar_candidatas_en_worker(region, nodo_inicio, distancia_estimada, estrategia):
+    # Devuelve las rutas candidatas, la traza del worker (None sin instrumentación), que se suma a la de la
+    # petición, y los contadores de este worker para las estadísticas del servicio
+    traza = instr.iniciar_traza('candidatas')
+    try:
+        if region is None:
+            G, zonas_verdes_gdf = recursos_worker['G'], recursos_worker['zonas_verdes_gdf']
+        else:
+            G, zonas_verdes_gdf = recursos_worker['registro'].obtener(region)
+        with instr.etapa('generar_candidatas'):
+            rutas = nrp.generar_candidatas(G, nodo_inicio, distancia_estimada, zonas_verdes_gdf, estrategia)
+    except Exception:
+        instr.extraer_traza(traza)
+        raise
+    recursos_worker['generadas'] += 1
+    estadisticas = {'pid': os.getpid(), 'candidatas_generadas': recursos_worker['generadas']}
+    if 'registro' in recursos_worker:
+        estadisticas['regiones'] = recursos_worker['registro'].estadisticas()
+    return rutas, instr.extraer_traza(traza), estadisticas
+
+def crear_pool_procesos(num_workers, directorio_grafo, nombre_archivo_zonas_verdes='parques.geojson',
+                        archivo_regiones=None, memoria_regiones=1 << 30):
+    # Pool que genera las candidatas para ResolutorRutas. El artefacto (o los de las regiones) debe estar ya
+    # compilado: los workers solo lo cargan. Se arrancan ya aquí (el pool los crea con el primer envío) para
+    # que cargar y precalentar no lo pague la primera petición
+    pool = ProcessPoolExecutor(max_workers=num_workers, initializer=inicializar_worker,
+                               initargs=(directorio_grafo, nombre_archivo_zonas_verdes, archivo_regiones,
+                                         memoria_regiones, instr.configuracion_serializable()))
+    for futuro in [pool.submit(os.getpid) for _ in range(num_workers)]:
+        futuro.result()
+    return pool
+
+class ServicioRutas:
+    # Servicio residente. Cada petición se atiende en un hilo de este proceso con el grafo y las zonas verdes
+    # cargados una vez (o el registro de regiones). Con pool (ver crear_pool_procesos) la búsqueda de
+    # candidatas, que es Python puro y no avanza en paralelo con el GIL, se reparte entre procesos worker y
+    # los hilos solo esperan su resultado; las peticiones con la misma clave se agrupan antes de enviarlas
+    def __init__(self, G=None, zonas_verdes_gdf=None, num_workers=4, max_latencias=1000, cache=None, registro=None,
+                 pool=None, num_hilos=None, intervalo_duracion=5):
+        self.resolutor = ResolutorRutas(G, zonas_verdes_gdf, cache, registro, pool, intervalo_duracion)
+        if G is not None:
+            # El ajuste del inicio y la selección de la ruta se hacen en este proceso
+            precalentar(G, zonas_verdes_gdf)
+        self.pool = pool
+        # Con procesos, varios hilos por worker para que las peticiones repetidas lleguen a agruparse mientras
+        # la primera está en un worker
+        self.num_hilos = num_hilos or (4 * num_workers if pool is not None else num_workers)
+        self.hilos = ThreadPoolExecutor(max_workers=self.num_hilos)
+        self.num_workers = num_workers
+        self.lock = threading.Lock()
+        self.latencias = deque(maxlen=max_latencias)
+        self.pendientes = 0
+        self.en_proceso = 0
+        self.completadas = 0
+        self.errores = 0
+
+    def enviar(self, json_input):
+        # El futuro devuelto se resuelve después de actualizar las estadísticas de la petición
+        instante_llegada = time.perf_counter()
+        with self.lock:
+            self.pendientes += 1
+        resultado = Future()
+        futuro = self.hilos.submit(self.atender, json_input)
+        futuro.add_done_callback(lambda f: self.terminar(f, resultado, instante_llegada))
+        return resultado
+
+    def atender(self, json_input):
+        with self.lock:
+            self.en_proceso += 1
+        try:
+            return self.resolutor.atender(json_input)
+        finally:
+            with self.lock:
+                self.en_proceso -= 1
+
+    def terminar(self, futuro, resultado, instante_llegada):
+        try:
+            respuesta, error = futuro.result()
+        except Exception as e:
+            respuesta, error = json.dumps({'error': str(e)}), True
+        with self.lock:
+            self.pendientes -= 1
+            self.completadas += 1
+            self.errores += error
+            self.latencias.append(time.perf_counter() - instante_llegada)
+        resultado.set_result(respuesta)
+
+    def estadisticas(self):
+        with self.lock:
+            latencias = sorted(self.latencias)
+            estadisticas = {
+                'encoladas': self.pendientes - self.en_proceso,
+                'en_proceso': self.en_proceso,
+                'completadas': self.completadas,
+                'errores': self.errores,
+            }
+        estadisticas.update(self.resolutor.estadisticas())
+        if latencias:
+            estadisticas['latencia_p50'] = latencias[len(latencias) // 2]
+            estadisticas['latencia_p95'] = latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))]
+            estadisticas['latencia_max'] = latencias[-1]
+        return estadisticas
+
+    def cerrar(self):
+        self.hilos.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+def servir_lineas_json(servicio, entrada, salida):
+    # Una petición JSON por línea; las respuestas se escriben en el mismo orden que las peticiones
+    pendientes = deque()
+    condicion = threading.Condition()
+    fin = object()
+
+    def escribir():
+        while True:
+            with condicion:
+                while not pendientes:
+                    condicion.wait()
+                futuro = pendientes.popleft()
+            if futuro is fin:
+                return
+            # Las estadísticas se calculan al llegar a su turno, después de todas las peticiones anteriores
+            respuesta = futuro.result() if isinstance(futuro, Future) else json.dumps(futuro())
+            salida.write(respuesta + '\n')
+            salida.flush()
+
+    escritor = threading.Thread(target=escribir)
+    escritor.start()
+    for linea in entrada:
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            peticion = json.loads(linea)
+        except json.JSONDecodeError:
+            peticion = None
+        if isinstance(peticion, dict) and peticion.get('comando') == 'estadisticas':
+            elemento = servicio.estadisticas
+        else:
+            elemento = servicio.enviar(linea)
+        with condicion:
+            pendientes.append(elemento)
+            condicion.notify()
+    with condicion:
+        pendientes.append(fin)
+        condicion.notify()
+    escritor.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servicio de rutas de paseo (JSON por líneas en stdin/stdout)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--hilos', action='store_true', help="Generar las candidatas en los hilos de este proceso en lugar de en procesos worker")
+    parser.add_argument('--directorio-grafo', default='grafo_burgos')
+    parser.add_argument('--cache-sqlite', default=None, help="Archivo SQLite para conservar la caché entre reinicios y compartirla entre servicios")
+    parser.add_argument('--intervalo-duracion', type=int, default=5, help="Minutos por clase de duración en la caché y al agrupar peticiones")
+    parser.add_argument('--regiones', default=None, help="Catálogo JSON de regiones; cada petición usa la de su punto")
+    parser.add_argument('--memoria-regiones', type=float, default=1024, help="MB de regiones cargadas a la vez")
+    args = parser.parse_args()
+    memoria_regiones = int(args.memoria_regiones * 2 ** 20)
+
+    # Compilar aquí lo que haga falta (los workers solo cargan) y descartar de la caché las rutas de
+    # versiones anteriores del grafo
+    cache = cache_rutas.CacheRutas(intervalo_duracion=args.intervalo_duracion, ruta_sqlite=args.cache_sqlite)
+    if args.regiones:
+        # Las regiones se cargan bajo demanda; la caché conserva las rutas de todas
+        registro = registro_regiones.RegistroRegiones.desde_catalogo(args.regiones, memoria_max=memoria_regiones)
+        G, zonas_verdes_gdf = None, None
+        cache.invalidar(registro.versiones())
+    else:
+        registro = None
+        G, zonas_verdes_gdf = main.cargar_recursos(args.directorio_grafo)
+        cache.invalidar(G.graph.get('version'))
+
+    pool = None
+    if not args.hilos:
+        pool = crear_pool_procesos(args.workers, args.directorio_grafo, archivo_regiones=args.regiones,
+                                   memoria_regiones=memoria_regiones)
+    servicio = ServicioRutas(G, zonas_verdes_gdf, num_workers=args.workers, cache=cache, registro=registro, pool=pool,
+                             intervalo_duracion=args.intervalo_duracion)
+    servir_lineas_json(servicio, sys.stdin, sys.stdout)
+    servicio.cerrar()
+    cache.cerrar()
+    print(json.dumps(servicio.estadisticas()), file=sys.stderr)
@@ -0,0 +1,50 @@
+import os
+import sys
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import distancias as dist
+import grafo_compacto
+import indice_espacial
+
+def grafo_cuadricula(n=20, separacion=0.0005):
+    # Cuadrícula n x n con los nodos algo desplazados y la longitud real de cada arista
+    rng = np.random.default_rng(0)
+    G = nx.Graph()
+    for fila in range(n):
+        for columna in range(n):
+            G.add_node(fila * n + columna, x=-3.70 + columna * separacion + rng.normal(0, 5e-5),
+                       y=42.34 + fila * separacion + rng.normal(0, 5e-5))
+    for fila in range(n):
+        for columna in range(n):
+            nodo = fila * n + columna
+            for vecino in ((nodo + 1) if columna < n - 1 else None, (nodo + n) if fila < n - 1 else None):
+                if vecino is not None:
+                    longitud = dist.distancia_entre_nodos(G, nodo, vecino, usar_aristas=False)
+                    G.add_edge(nodo, vecino, weight=longitud, longitud=longitud)
+    return grafo_compacto.desde_networkx(G)
+
+def test_transiciones_en_subgrafo_local_igual_que_en_todo_el_grafo():
+    G = grafo_cuadricula()
+    emparejador = indice_espacial.EmparejadorTrazas(G)
+    rng = np.random.default_rng(1)
+    nodos = list(G.nodes)
+    for _ in range(20):
+        candidatos_prev = [nodos[i] for i in rng.choice(len(nodos), 5, replace=False)]
+        candidatos = [nodos[i] for i in rng.choice(len(nodos), 5, replace=False)]
+        recta = float(rng.uniform(20, 300))
+        limite = recta + 2 * emparejador.radio_busqueda
+        origenes = [emparejador.posiciones[nodo] for nodo in candidatos_prev]
+        destinos = [emparejador.posiciones[nodo] for nodo in candidatos]
+        por_red = dijkstra(emparejador.longitudes, directed=False, indices=origenes, limit=limite)[:, destinos]
+        esperadas = np.where(np.isfinite(por_red), -np.abs(por_red - recta) / emparejador.beta, -np.inf)
+        np.testing.assert_allclose(emparejador.transiciones(candidatos_prev, candidatos, recta), esperadas)
+
+def test_emparejar_traza_sigue_la_red():
+    G = grafo_cuadricula()
+    camino = [0, 1, 2, 22, 42, 43, 44, 64]
+    puntos = [(G.nodes[nodo]['y'], G.nodes[nodo]['x']) for nodo in camino]
+    assert indice_espacial.emparejar_traza(G, puntos) == camino
@@ -0,0 +1,80 @@
+import os
+import sys
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import grafo_compacto
+import nodos_rutas_y_pesos as nrp
+
+SEPARACION = 0.0005  # Grados entre cruces de la cuadrícula (unos 50 m)
+FACTORES = {'factor_reduccion': 0.5, 'factor_reduccion_dog_park': 0.7}
+
+def grafo_cuadricula(n=5):
+    # Cuadrícula n x n con la longitud de cada arista como peso, igual que crear_grafo_desde_geojson
+    G = nx.Graph()
+    for fila in range(n):
+        for columna in range(n):
+            G.add_node(fila * n + columna, x=-3.70 + columna * SEPARACION, y=42.34 + fila * SEPARACION)
+    for fila in range(n):
+        for columna in range(n):
+            nodo = fila * n + columna
+            for vecino in ((nodo + 1) if columna < n - 1 else None, (nodo + n) if fila < n - 1 else None):
+                if vecino is not None:
+                    G.add_edge(nodo, vecino, weight=50.0 + nodo, longitud=50.0 + nodo)
+    G.graph['crs'] = 'epsg:4326'
+    return G
+
+def zonas_verdes():
+    # Un parque, un dog park que se solapa con él, un jardín marcado como dog park en tipo_jardin y un
+    # triángulo cuya caja contiene centroides que quedan fuera del polígono (distancias no nulas)
+    s = SEPARACION
+    x0, y0 = -3.70, 42.34
+    geometrias = [
+        Polygon([(x0 - s / 4, y0 - s / 4), (x0 + 1.5 * s, y0 - s / 4), (x0 + 1.5 * s, y0 + 1.5 * s), (x0 - s / 4, y0 + 1.5 * s)]),
+        Polygon([(x0 + s, y0 + s), (x0 + 2.5 * s, y0 + s), (x0 + 2.5 * s, y0 + 2.5 * s), (x0 + s, y0 + 2.5 * s)]),
+        Polygon([(x0 + 3 * s, y0), (x0 + 4 * s, y0), (x0 + 4 * s, y0 + s / 3), (x0 + 3 * s, y0 + s / 3)]),
+        Polygon([(x0, y0 + 3 * s), (x0 + 4 * s, y0 + 3 * s), (x0, y0 + 4 * s)]),
+    ]
+    return gpd.GeoDataFrame({'leisure': ['park', 'dog_park', 'garden', 'park'],
+                             'tipo_jardin': [None, None, 'dog_park', None]},
+                            geometry=geometrias, crs='epsg:4326')
+
+def aristas(G):
+    return {tuple(sorted((u, v))): data for u, v, data in G.edges(data=True)}
+
+@pytest.mark.parametrize('distancia_umbral', [10, 0.0002])
+def test_en_bloque_igual_que_por_arista(distancia_umbral):
+    por_arista, en_bloque = grafo_cuadricula(), grafo_cuadricula()
+    nrp.aplicar_peso_zonas_verdes(por_arista, zonas_verdes(), distancia_umbral, en_bloque=False, **FACTORES)
+    nrp.aplicar_peso_zonas_verdes(en_bloque, zonas_verdes(), distancia_umbral, en_bloque=True, **FACTORES)
+
+    esperadas, obtenidas = aristas(por_arista), aristas(en_bloque)
+    assert esperadas.keys() == obtenidas.keys()
+    for clave, data in esperadas.items():
+        assert obtenidas[clave]['weight'] == pytest.approx(data['weight'])
+        assert obtenidas[clave]['distancia_zona_verde'] == pytest.approx(data['distancia_zona_verde'])
+        assert obtenidas[clave]['es_dog_park'] == data['es_dog_park']
+    # La cuadrícula tiene aristas reducidas por parque, por dog park y sin reducir
+    factores = {round(data['weight'] / data['longitud'], 6) for data in esperadas.values()}
+    assert factores == {0.5, 0.7, 1.0}
+
+@pytest.mark.parametrize('distancia_umbral', [10, 0.0002])
+def test_en_bloque_sobre_grafo_compacto(distancia_umbral):
+    por_arista = grafo_cuadricula()
+    nrp.aplicar_peso_zonas_verdes(por_arista, zonas_verdes(), distancia_umbral, en_bloque=False, **FACTORES)
+    compacto = grafo_compacto.desde_networkx(grafo_cuadricula())
+    nrp.aplicar_peso_zonas_verdes(compacto, zonas_verdes(), distancia_umbral, en_bloque=True, **FACTORES)
+
+    esperadas = aristas(por_arista)
+    for u, v, data in compacto.edges(data=True):
+        esperada = esperadas[tuple(sorted((u, v)))]
+        assert data['weight'] == pytest.approx(esperada['weight'])
+        assert data['es_dog_park'] == esperada['es_dog_park']
+        # Los dos sentidos de la arista en el CSR llevan el mismo peso
+        assert compacto.peso(v, u) == pytest.approx(esperada['weight'])
+    assert np.array_equal(compacto.longitudes, grafo_compacto.desde_networkx(grafo_cuadricula()).longitudes)
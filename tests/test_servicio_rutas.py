@@ -0,0 +1,80 @@
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import geopandas as gpd
+import networkx as nx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import grafo_compacto
+import servicio_rutas
+
+def grafo_cuadricula(n=6, separacion=0.0005):
+    # Cuadrícula n x n con aristas de unos 50 m
+    G = nx.Graph()
+    for fila in range(n):
+        for columna in range(n):
+            G.add_node(fila * n + columna, x=-3.70 + columna * separacion, y=42.34 + fila * separacion)
+    for fila in range(n):
+        for columna in range(n):
+            nodo = fila * n + columna
+            if columna < n - 1:
+                G.add_edge(nodo, nodo + 1, weight=50.0, longitud=50.0)
+            if fila < n - 1:
+                G.add_edge(nodo, nodo + n, weight=50.0, longitud=50.0)
+    return grafo_compacto.desde_networkx(G)
+
+def sin_zonas_verdes():
+    return gpd.GeoDataFrame({'leisure': []}, geometry=[], crs='epsg:4326')
+
+def peticion(G, nodo, duracion=100):
+    return json.dumps({'latitud': G.nodes[nodo]['y'], 'longitud': G.nodes[nodo]['x'], 'duracion': duracion,
+                       'tamaño': 'mediano', 'edad': 5, 'raza': 'labrador'})
+
+class PoolLento(ThreadPoolExecutor):
+    # Sustituye al pool de procesos: retrasa cada envío para que las peticiones repetidas lleguen mientras
+    # la primera está en curso
+    def submit(self, *args, **kwargs):
+        time.sleep(0.2)
+        return super().submit(*args, **kwargs)
+
+def test_peticiones_iguales_comparten_candidatas():
+    G = grafo_cuadricula()
+    servicio_rutas.recursos_worker.update({'G': G, 'zonas_verdes_gdf': sin_zonas_verdes(), 'generadas': 0})
+    servicio = servicio_rutas.ServicioRutas(G, sin_zonas_verdes(), num_workers=1, pool=PoolLento(max_workers=1))
+    try:
+        respuestas = [futuro.result() for futuro in [servicio.enviar(peticion(G, 14)) for _ in range(4)]]
+        estadisticas = servicio.estadisticas()
+    finally:
+        servicio.cerrar()
+        servicio_rutas.recursos_worker.clear()
+
+    assert len(set(respuestas)) == 1
+    assert len(json.loads(respuestas[0])['ruta']) > 2
+    assert estadisticas['candidatas_generadas'] == 1
+    assert estadisticas['candidatas_compartidas'] == 3
+    assert [worker['candidatas_generadas'] for worker in estadisticas['workers']] == [1]
+    assert estadisticas['en_proceso'] == 0 and estadisticas['encoladas'] == 0
+
+def test_datos_incorrectos_dan_linea_de_error(capsys):
+    G = grafo_cuadricula()
+    servicio = servicio_rutas.ServicioRutas(G, sin_zonas_verdes(), num_workers=2)
+    entrada = io.StringIO('\n'.join(['no es json', '{"latitud": 42.34}', peticion(G, 7),
+                                     '{"comando": "estadisticas"}']) + '\n')
+    salida = io.StringIO()
+    servicio_rutas.servir_lineas_json(servicio, entrada, salida)
+    servicio.cerrar()
+
+    lineas = [json.loads(linea) for linea in salida.getvalue().splitlines()]
+    assert len(lineas) == 4
+    assert lineas[0] == {'error': "No se pudieron cargar los datos del perro."}
+    assert lineas[1]['error'].startswith("Faltan campos")
+    assert 'ruta' in lineas[2]
+    assert lineas[3]['errores'] == 2 and lineas[3]['completadas'] == 3
+    # El aviso del JSON mal formado va por stderr, nunca mezclado con las respuestas
+    capturado = capsys.readouterr()
+    assert capturado.out == ''
+    assert 'Error al decodificar el JSON' in capturado.err